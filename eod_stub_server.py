@@ -0,0 +1,288 @@
+'''
+eod_stub_server.py
+Local stand-in for the EOD Historical Data end-of-day API called by get_stock_prices.
+Serves recorded or synthetic daily prices with configurable latency, server errors and 429 throttling,
+so that the concurrency, connection pooling and retry settings can be tuned without using the vendor quota.
+Run with: python eod_stub_server.py --port 8080 --latency 0.05 --error-rate 0.01 --quota 1000
+then point EODProvider(base_url='http://127.0.0.1:8080') at it. Its prices are cached apart from EOD's, under
+the vendor eod-127.0.0.1_8080, set PRICE_CACHE_DIR to a scratch directory or price_cache_dir to None to keep
+them out of the price store altogether.
+'''
+
+import argparse
+import bisect
+import gzip
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+import numpy as np
+import pandas as pd
+
+
+# %% functions
+@lru_cache(maxsize=4096)
+def synthetic_bars(ticker):
+    """
+    Function to generate a reproducible random walk of daily bars for ``ticker``, in the EOD JSON layout.
+    The same ticker always returns the same history, so that delta requests line up with earlier ones.
+    :param ticker: string.
+    :return: tuple(list, list). The dates as strings and the bars, one per business day since 2000.
+    """
+
+    seed = int(hashlib.md5(ticker.encode()).hexdigest()[:8], 16)
+    rng = np.random.default_rng(seed)
+
+    dates = pd.bdate_range('2000-01-03', date_today()).strftime('%Y-%m-%d').tolist()
+    prices = (100 * np.exp(np.cumsum(rng.normal(0.0003, 0.01, len(dates))))).round(4).tolist()
+
+    bars = [
+        {'date': day, 'open': price, 'high': price, 'low': price, 'close': price,
+         'adjusted_close': price, 'volume': 1000}
+        for day, price in zip(dates, prices)
+    ]
+
+    return dates, bars
+
+
+def date_today():
+    """
+    Today's date as a string.
+    """
+
+    return pd.Timestamp.today().strftime('%Y-%m-%d')
+
+
+def load_recorded_prices(data_dir, ticker, start_date, end_date):
+    """
+    Function to read a recorded JSON response, saved as ``<data_dir>/<ticker>.json``.
+    :return: list[dict]. The bars between start_date and end_date, or None if the ticker was not recorded.
+    """
+
+    path = os.path.join(data_dir, f'{ticker}.json')
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        bars = json.load(f)
+
+    return [bar for bar in bars if start_date <= bar['date'] <= end_date]
+
+
+def get_bars(options, ticker, start_date, end_date):
+    """
+    Function to return the bars of ``ticker`` in the EOD JSON layout, recorded when available, otherwise synthetic.
+    """
+
+    if options['data_dir']:
+        bars = load_recorded_prices(options['data_dir'], ticker, start_date, end_date)
+
+        if bars is not None:
+            return bars
+
+    dates, bars = synthetic_bars(ticker)
+
+    return bars[bisect.bisect_left(dates, start_date):bisect.bisect_right(dates, end_date)]
+
+
+@lru_cache(maxsize=4096)
+def synthetic_body(ticker, start_date, end_date, fmt, compress):
+    """
+    Function to return the serialized, and optionally gzipped, synthetic response body.
+    Cached, so that a benchmark measures the client rather than the stand-in server.
+    :return: tuple(bytes, string). The body and its content type.
+    """
+
+    body, content_type = format_bars(get_bars({'data_dir': None}, ticker, start_date, end_date), fmt)
+
+    return (gzip.compress(body, compresslevel=6) if compress else body), content_type
+
+
+def format_bars(bars, fmt):
+    """
+    Function to serialize bars as the EOD JSON or CSV response body.
+    """
+
+    if fmt == 'csv':
+        lines = ['Date,Open,High,Low,Close,Adjusted_close,Volume']
+        lines += [f"{b['date']},{b['open']},{b['high']},{b['low']},{b['close']},{b['adjusted_close']},{b['volume']}"
+                  for b in bars]
+        return ('\n'.join(lines) + '\n').encode(), 'text/csv'
+
+    return json.dumps(bars).encode(), 'application/json'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Request handler for /api/eod/{ticker} and /api/eod-bulk-last-day/{exchange}.
+    The server's ``options`` dict holds the latency, error and throttling settings.
+    """
+
+    # keep-alive, like the real API
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.options['verbose']:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        options = self.server.options
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        time.sleep(max(0.0, random.gauss(options['latency'], options['latency_jitter'])))
+
+        if not self.server.take_token() or random.random() < options['throttle_rate']:
+            return self.send_body(429, b'', 'text/plain', {'Retry-After': str(options['retry_after'])})
+
+        if random.random() < options['error_rate']:
+            return self.send_body(503, b'', 'text/plain')
+
+        if url.path.startswith('/api/eod/'):
+            ticker = url.path.rsplit('/', 1)[-1]
+            start_date, end_date = query.get('from', '2000-01-01'), query.get('to', date_today())
+            fmt = query.get('fmt', 'json')
+
+            if not options['data_dir'] or not os.path.exists(os.path.join(options['data_dir'], f'{ticker}.json')):
+                compress = 'gzip' in self.headers.get('Accept-Encoding', '')
+                body, content_type = synthetic_body(ticker, start_date, end_date, fmt, compress)
+                return self.send_body(200, body, content_type, {'Content-Encoding': 'gzip'} if compress else None,
+                                      encoded=True)
+
+            bars = get_bars(options, ticker, start_date, end_date)
+            body, content_type = format_bars(bars, fmt)
+
+        elif url.path.startswith('/api/eod-bulk-last-day/'):
+            exchange = url.path.rsplit('/', 1)[-1]
+            day = query.get('date', date_today())
+            rows = []
+
+            for code in filter(None, query.get('symbols', '').split(',')):
+                bars = get_bars(options, f'{code}.{exchange}', '2000-01-01', day)
+
+                if bars:
+                    rows.append({'code': code, 'exchange_short_name': exchange, **bars[-1]})
+
+            body, content_type = json.dumps(rows).encode(), 'application/json'
+
+        else:
+            return self.send_body(404, b'', 'text/plain')
+
+        self.send_body(200, body, content_type)
+
+    def send_body(self, status, body, content_type, headers=None, encoded=False):
+        if 'gzip' in self.headers.get('Accept-Encoding', '') and body and not encoded:
+            body = gzip.compress(body, compresslevel=6)
+            headers = {**(headers or {}), 'Content-Encoding': 'gzip'}
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server enforcing a per-minute request quota, like the vendor.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, options):
+        super().__init__(address, StubHandler)
+        self.options = options
+        self.tokens = options['quota'] / 60
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take_token(self):
+        """
+        Take one request from the quota, return False when the quota is exhausted.
+        """
+
+        if not self.options['quota']:
+            return True
+
+        rate = self.options['quota'] / 60
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(rate, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+
+            if self.tokens < 1:
+                return False
+
+            self.tokens -= 1
+            return True
+
+
+def start_stub_server(host='127.0.0.1', port=0, latency=0.05, latency_jitter=0.01, error_rate=0.0,
+                      throttle_rate=0.0, retry_after=1, quota=0, data_dir=None, verbose=False):
+    """
+    Function to start the stand-in server on a background thread.
+    :param host: string.
+    :param port: int. 0 picks a free port.
+    :param latency: float. Mean response time in seconds.
+    :param latency_jitter: float. Standard deviation of the response time in seconds.
+    :param error_rate: float. Share of requests answered with HTTP 503.
+    :param throttle_rate: float. Share of requests answered with HTTP 429, on top of the quota.
+    :param retry_after: int. Retry-After header of throttled responses, in seconds.
+    :param quota: int. Requests per minute before answering HTTP 429. 0 disables the quota.
+    :param data_dir: string. Directory of recorded JSON responses named <ticker>.json.
+    :param verbose: bool. Log every request.
+    :return: StubServer. Its url is f'http://{host}:{server.server_port}'.
+    """
+
+    options = {
+        'latency': latency,
+        'latency_jitter': latency_jitter,
+        'error_rate': error_rate,
+        'throttle_rate': throttle_rate,
+        'retry_after': retry_after,
+        'quota': quota,
+        'data_dir': data_dir,
+        'verbose': verbose,
+    }
+
+    server = StubServer((host, port), options)
+    threading.Thread(target=server.serve_forever, name='eod-stub-server', daemon=True).start()
+
+    return server
+
+
+# %% execute
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.05, help='mean response time in seconds')
+    parser.add_argument('--latency-jitter', type=float, default=0.01, help='standard deviation of the response time')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of HTTP 503 responses')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of HTTP 429 responses')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of HTTP 429 responses, in seconds')
+    parser.add_argument('--quota', type=int, default=0, help='requests per minute, 0 for no quota')
+    parser.add_argument('--data-dir', help='directory of recorded JSON responses named <ticker>.json')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    stub_server = start_stub_server(**vars(args))
+    print(f'EOD stand-in listening on http://{args.host}:{stub_server.server_port}')
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        stub_server.shutdown()
@@ -7,31 +7,101 @@ Created by Cordell L. Tanny, CFA, FRM, FDP
 February 2023
 '''
 
+import asyncio
+import io
 import json
 import os
+import random
+import re
 import ssl
+import tempfile
+import threading
+import time
 import warnings
-from urllib.request import urlopen
+from contextlib import nullcontext
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+from typing import Protocol
+import aiohttp
+import certifi
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from scipy import stats
 from sklearn.linear_model import LassoLars
 from sklearn.linear_model import LassoLarsIC
 from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import StandardScaler
-from statsmodels.regression.linear_model import OLS
-from statsmodels.stats.outliers_influence import variance_inflation_factor
-from statsmodels.tools.tools import add_constant
+from statsmodels.iolib.summary import Summary
+from statsmodels.iolib.summary import summary_params
 
 # prevent FutureWarnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
-# context for certificates needed in urllib/requests
-ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+# context for certificates needed in urllib/requests.
+# TLS 1.2 is the minimum, TLS 1.3 is negotiated when the server supports it
+ssl_context = ssl.create_default_context(cafile=certifi.where())
+ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
 
 # %% initialization
 start_date = '2012-01-01'
 end_date = '2023-02-28'
 
-eod_api_key = os.environ['EOD_API_KEY']
+# only required by EODProvider, so that the functions can be imported without it
+eod_api_key = os.environ.get('EOD_API_KEY')
+
+# prices retrieved from another base url are cached under another vendor, see EODProvider
+eod_base_url = 'https://eodhistoricaldata.com'
+
+# maximum number of symbols requested from the data provider at the same time
+max_workers = 8
+
+# cap of the connection pool shared by every caller, the max_workers of each call decide the concurrency
+max_connections = 100
+
+# request quota of the data provider, shared by every request of the process.
+# throttled (HTTP 429), server error (HTTP 5xx) and dropped requests are retried up to max_retries times
+requests_per_minute = 1000
+max_retries = 5
+retry_statuses = (429, 500, 502, 503, 504)
+
+# local Parquet price store consulted before any request to the data provider.
+# set price_cache_dir to None to always download the prices
+price_cache_dir = os.environ.get('PRICE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.fdp_price_cache'))
+price_cache_max_bytes = 2 * 1024 ** 3
+
+# size of the price store of each directory, walked once and then tracked by write_cached_prices
+price_cache_bytes = {}
+price_cache_lock = threading.Lock()
+
+# price columns kept from the data provider responses, and the response format ('json' or 'csv')
+price_fields = ('adjusted_close',)
+eod_format = 'json'
+
+# return frequencies derived from the daily price panel: daily, weekly, monthly and quarterly.
+# the price and return panels of the last max_cached_panels universes are kept in memory by the FetchClient
+return_frequencies = ('D', 'W', 'M', 'Q')
+max_cached_panels = 8
+
+# storage type of the return panels and of the daily price panels kept in memory. np.float32 halves their memory
+# and bandwidth, the returns are calculated and the regressions accumulated in float64 either way.
+# see precision_check.py for the accuracy cost
+return_dtype = np.float64
+
+# risk-free rate of the excess returns, the returns of a T-bill ETF retrieved and cached like any other symbol
+risk_free_symbol = 'BIL'
+
+# aligned fund and factor returns shared between the batch job and the app, see save_return_panels.
+# the execute section saves them there, and the app loads them instead of recalculating when they match
+return_panel_path = os.environ.get('RETURN_PANEL_PATH')
+
+# connection pool shared by every request of the process, see get_fetch_client
+fetch_client = None
+fetch_client_lock = threading.Lock()
 
 tickers = [
     'QIACX',
@@ -66,164 +136,2377 @@ factors_dict = {
 
 
 # %% functions
-def get_stock_prices(symbol, start_date, end_date):
+def get_cache_path(vendor, symbol):
     """
-    Receive the content of ``url``, parse it as JSON and return the object.
+    Location of the Parquet file holding the cached prices of ``symbol`` retrieved from ``vendor``.
     """
 
-    if '.TO' not in symbol:
-        ticker = symbol + '.US'
-    else:
-        ticker = symbol
+    return os.path.join(price_cache_dir, vendor, f'{symbol}.parquet')
 
-    url = f'https://eodhistoricaldata.com/api/eod/{ticker}?from={start_date}&to={end_date}&' \
-          f'period=d&api_token={eod_api_key}&fmt=json'
 
-    response = urlopen(url, context=ssl_context)
-    data = response.read().decode("utf-8")
+def last_final_date():
+    """
+    Most recent date whose daily bar can no longer change, i.e. yesterday.
+    """
 
-    prices = json.loads(data)
+    return (date.today() - timedelta(days=1)).isoformat()
 
-    prices = pd.DataFrame(prices).set_index('date').sort_index()
 
-    return prices
+def read_cached_prices(vendor, symbol, fields=None):
+    """
+    Function to read the cached prices of a symbol from the local price store.
+    Reading a symbol marks it as recently used for the eviction policy.
+    :param vendor: string. Data provider the prices were retrieved from.
+    :param symbol: string.
+    :param fields: list[strings]. Columns to read. Defaults to every cached column.
+    :return: tuple(pd.DataFrame, string, string). The prices and the date range they were retrieved for,
+    or None if the symbol or one of the fields is not cached.
+    """
+
+    if not price_cache_dir:
+        return None
+
+    path = get_cache_path(vendor, symbol)
+    columns = ['date', *fields] if fields else None
 
+    try:
+        table = pq.read_table(path, columns=columns)
+        os.utime(path)
+    except (FileNotFoundError, KeyError, pa.ArrowInvalid):
+        return None
 
-def get_returns(tickers: list, start_date, end_date, frequency='M'):
+    metadata = table.schema.metadata
+    prices = table.to_pandas().set_index('date')
+    prices.index = pd.DatetimeIndex(prices.index)
+
+    return prices, metadata[b'fetched_from'].decode(), metadata[b'fetched_to'].decode()
+
+
+def select_cached_prices(cached, start_date, end_date, fields):
     """
-    Function to calculate returns based on the supplied prices and frequency.
-    :param tickers: list[strings]. Yahoo finance tickers supplied as a list.
+    Function to slice the cached prices returned by read_cached_prices to the requested dates and columns.
+    Bars up to yesterday are final, so an end_date in the future is covered by a store that is complete up to yesterday.
+    :param cached: tuple or None. Output of read_cached_prices.
+    :param start_date: string.
+    :param end_date: string.
+    :param fields: list[strings]. Price columns to return.
+    :return: pd.DataFrame, or None if the cache does not cover the whole date range or one of the columns.
+    """
+
+    if cached is None:
+        return None
+
+    prices, fetched_from, fetched_to = cached
+
+    covered = fetched_from <= start_date and fetched_to >= min(end_date, last_final_date())
+
+    if covered and set(fields) <= set(prices.columns):
+        return prices.loc[start_date:end_date, list(fields)]
+
+    return None
+
+
+def get_delta_request(cached, start_date, end_date, fields):
+    """
+    Function to find the dates and columns that must be requested from the data provider.
+    When the cached history already starts on or before start_date, only the bars after the last cached bar are missing.
+    The last cached bar is requested again, so that is_history_adjusted can compare it with the cached one.
+    The cached columns are always requested with the new ones, and a column missing from the cache is requested
+    over the whole cached date range, so that every column of the store covers the same dates.
+    :param cached: tuple or None. Output of read_cached_prices.
+    :param start_date: string.
+    :param end_date: string.
+    :param fields: list[strings]. Price columns to return.
+    :return: tuple(string, string, tuple). Start date, end date and columns of the request.
+    """
+
+    if cached is None:
+        return start_date, end_date, tuple(fields)
+
+    prices, fetched_from, fetched_to = cached
+    fetch_fields = tuple(dict.fromkeys([*prices.columns, *fields]))
+
+    if len(fetch_fields) > len(prices.columns):
+        return min(start_date, fetched_from), max(end_date, fetched_to), fetch_fields
+
+    if fetched_from > start_date or prices.empty:
+        return start_date, end_date, fetch_fields
+
+    return prices.index[-1].date().isoformat(), end_date, fetch_fields
+
+
+def is_history_adjusted(cached, prices, fetch_start):
+    """
+    Function to detect that the data provider re-scaled the adjusted history of a symbol since it was cached,
+    e.g. after a dividend or a split. The bar overlapping the cached history then differs from the cached bar,
+    and the whole history must be requested again.
+    :param cached: tuple or None. Output of read_cached_prices.
+    :param prices: pd.DataFrame. Prices retrieved from fetch_start.
+    :param fetch_start: string. Start date of get_delta_request.
+    :return: bool.
+    """
+
+    if cached is None or cached[0].empty:
+        return False
+
+    cached_prices = cached[0]
+    overlap = cached_prices.index[-1]
+
+    if overlap.date().isoformat() != fetch_start:
+        return False
+
+    return overlap not in prices.index or not prices.loc[overlap, cached_prices.columns].equals(
+        cached_prices.loc[overlap])
+
+
+def write_cached_prices(vendor, symbol, prices, start_date, end_date, cached=None):
+    """
+    Function to save the prices of a symbol to the local price store.
+    Prices already cached for an overlapping date range are kept, so a delta retrieved from get_delta_request
+    is appended to the cached history. Only the final bars, up to yesterday, are written, so that the bar of
+    the current day is requested again once it is final. The file is written under a temporary name and then
+    renamed, so that readers never see a partially written file, and the store is then trimmed to
+    price_cache_max_bytes by evict_price_cache.
+    :param vendor: string. Data provider the prices were retrieved from.
+    :param symbol: string.
+    :param prices: pd.DataFrame. Prices retrieved for the date range below, indexed by date.
     :param start_date: string.
     :param end_date: string.
-    :param frequency: string. 'D' for daily, 'M' for monthly. Default is monthly.
+    :param cached: tuple or None. Output of read_cached_prices for the same symbol.
+    :return: pd.DataFrame. The prices merged with the cached history, including the bars that are not final.
+    """
+
+    if not price_cache_dir:
+        return prices
+
+    fetched_from = start_date
+    fetched_to = min(end_date, last_final_date())
+
+    if cached is not None:
+        cached_prices, cached_from, cached_to = cached
+
+        # merge with the cached history when both date ranges overlap or are adjacent
+        day_after_cached = (date.fromisoformat(cached_to) + timedelta(days=1)).isoformat()
+
+        if cached_from <= fetched_to and start_date <= day_after_cached:
+            prices = pd.concat([cached_prices, prices])
+            prices = prices[~prices.index.duplicated(keep='last')].sort_index()
+            fetched_from = min(cached_from, fetched_from)
+            fetched_to = max(cached_to, fetched_to)
+
+    final_prices = prices.loc[:fetched_to]
+    table = pa.Table.from_pandas(final_prices.rename_axis('date').reset_index(), preserve_index=False)
+    table = table.replace_schema_metadata({
+        **table.schema.metadata,
+        b'fetched_from': fetched_from.encode(),
+        b'fetched_to': fetched_to.encode(),
+    })
+
+    path = get_cache_path(vendor, symbol)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    try:
+        old_size = os.path.getsize(path)
+    except FileNotFoundError:
+        old_size = 0
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pq.write_table(table, f)
+        new_size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    with price_cache_lock:
+        if price_cache_dir in price_cache_bytes:
+            price_cache_bytes[price_cache_dir] += new_size - old_size
+
+    evict_price_cache()
+
+    return prices
+
+
+def evict_price_cache(max_bytes=None):
+    """
+    Function to delete the least recently used symbols from the local price store until it fits in ``max_bytes``.
+    The store is only walked when its size is not tracked yet, i.e. once per process, or when it is too large.
+    :param max_bytes: int. Size limit of the store. Defaults to price_cache_max_bytes.
+    :return: None
+    """
+
+    if not price_cache_dir:
+        return
+
+    if max_bytes is None:
+        max_bytes = price_cache_max_bytes
+
+    with price_cache_lock:
+        if price_cache_bytes.get(price_cache_dir, max_bytes + 1) <= max_bytes:
+            return
+
+    files = []
+
+    for root, _, names in os.walk(price_cache_dir):
+        for name in names:
+            if not name.endswith('.parquet'):
+                continue
+
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            files.append((stat.st_mtime, stat.st_size, path))
+
+    total_bytes = sum(size for _, size, _ in files)
+
+    # a full store is trimmed to 90% of max_bytes, so that the next writes do not walk it again
+    target_bytes = max_bytes if total_bytes <= max_bytes else 0.9 * max_bytes
+
+    # oldest access time first
+    for _, size, path in sorted(files):
+        if total_bytes <= target_bytes:
+            break
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+        total_bytes -= size
+
+    with price_cache_lock:
+        price_cache_bytes[price_cache_dir] = total_bytes
+
+
+def parse_eod_json(data, fields):
+    """
+    Function to extract ``fields`` from a JSON response of EOD Historical Data.
+    Each column is found with one scan of the raw bytes, so neither the decoded text nor a dict per row is built.
+    The matches of a column are aligned with the dates by position, so a response where a column is not matched
+    once per row, e.g. a bar missing a field, is decoded row by row with json.loads instead.
+    :param data: bytes. JSON array of daily bars.
+    :param fields: list[strings]. Numeric columns to extract.
+    :return: tuple(np.ndarray, dict). Dates as datetime64 and the columns as float64 arrays.
+    """
+
+    n_rows = data.count(b'"date"')
+    raw_dates = re.findall(rb'"date":\s*"(\d{4}-\d{2}-\d{2})"', data)
+    raw_values = {
+        field: re.findall(rb'"%s":\s*(-?[\d.eE+-]+|null)' % field.encode(), data) for field in fields
+    }
+
+    if any(len(raw) != n_rows for raw in [raw_dates, *raw_values.values()]):
+        rows = json.loads(data)
+        dates = np.array([row['date'] for row in rows], dtype='datetime64[D]')
+        values = {field: np.array([row.get(field) for row in rows], dtype=np.float64) for field in fields}
+
+        return dates, values
+
+    dates = np.empty(n_rows, dtype='datetime64[D]')
+    dates[:] = raw_dates
+
+    values = {}
+
+    for field, raw in raw_values.items():
+        raw = np.array(raw, dtype=bytes)
+        raw[raw == b'null'] = b'nan'
+
+        values[field] = np.empty(n_rows, dtype=np.float64)
+        values[field][:] = raw
+
+    return dates, values
+
+
+def parse_eod_csv(data, fields):
+    """
+    Function to extract ``fields`` from a CSV response of EOD Historical Data.
+    Only the date and the requested columns are parsed by numpy's C reader.
+    :param data: bytes. CSV content with a header row.
+    :param fields: list[strings]. Numeric columns to extract.
+    :return: tuple(np.ndarray, dict). Dates as datetime64 and the columns as float64 arrays.
+    """
+
+    header, _, body = data.partition(b'\n')
+    columns = header.decode().strip().lower().split(',')
+    usecols = [columns.index(field) for field in fields]
+
+    dates = np.loadtxt(io.BytesIO(body), delimiter=',', usecols=0, dtype='datetime64[D]', ndmin=1)
+    table = np.loadtxt(io.BytesIO(body), delimiter=',', usecols=usecols, dtype=np.float64, ndmin=2)
+
+    values = {field: table[:, i] for i, field in enumerate(fields)}
+
+    return dates, values
+
+
+def parse_eod_prices(data, fields=price_fields, fmt=None):
+    """
+    Parse the content returned by EOD Historical Data into a DataFrame indexed by date.
+    Only the requested columns are extracted from the response.
+    :param data: bytes. Response content.
+    :param fields: list[strings]. Columns to keep. Defaults to price_fields.
+    :param fmt: string. 'json' or 'csv'. Defaults to eod_format.
     :return: pd.DataFrame
     """
 
-    df_prices = pd.DataFrame()
+    match fmt or eod_format:
+        case 'json':
+            dates, values = parse_eod_json(data, fields)
+        case 'csv':
+            dates, values = parse_eod_csv(data, fields)
+
+    # the data provider returns ascending dates, only sort when it did not
+    if np.any(dates[1:] < dates[:-1]):
+        order = np.argsort(dates, kind='stable')
+        dates = dates[order]
+        values = {field: column[order] for field, column in values.items()}
+
+    prices = pd.DataFrame(values, index=pd.DatetimeIndex(dates, name='date'), columns=list(fields))
+
+    return prices
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. Tokens refill continuously at ``rate`` per second up to ``capacity``,
+    and every request takes one token, waiting for it when the bucket is empty.
+    A pause revokes the tokens handed out to the waiting requests, which take a new one once it is over.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.pauses = 0
+        self.lock = threading.Lock()
 
-    for ticker in tickers:
-        df_temp = get_stock_prices(ticker, start_date, end_date)[['adjusted_close']]
+    def reserve(self):
+        """
+        Take one token and return the number of seconds to wait before using it, and the number of pauses so far.
+        """
 
-        # convert the index to datetime
-        df_temp.index = pd.to_datetime(df_temp.index)
+        with self.lock:
+            # during a pause ``updated`` is its end, the bucket refills from there
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+            self.updated = max(now, self.updated)
+            self.tokens -= 1
 
-        # add the prices to df_prices
-        df_prices = pd.concat([df_prices, df_temp], axis=1)
+            return max(0.0, self.updated - now - self.tokens / self.rate), self.pauses
 
-    # calculate the percent change based on the desired frequency
-    match frequency:
-        case 'D':
-            df_returns = df_prices.pct_change().dropna()
+    def pause(self, seconds):
+        """
+        Hold back every request for ``seconds``, e.g. after the data provider throttled one of them.
+        """
 
-            # create a compound growth index
+        with self.lock:
+            resume = time.monotonic() + seconds
 
-        case 'M':
-            df_returns = df_prices.resample('M').last().pct_change().dropna()
+            if resume > self.updated:
+                self.tokens = 0.0
+                self.updated = resume
+                self.pauses += 1
 
-            # create a compound growth index
+    async def acquire(self):
+        """
+        Wait until a token is available.
+        """
 
-    # rename the columns
-    df_returns.columns = tickers
+        while True:
+            delay, pauses = self.reserve()
 
-    print('All tickers successfully retrieved')
+            if delay > 0:
+                await asyncio.sleep(delay)
 
-    return df_returns
+            # a token reserved before a pause was revoked by it
+            if pauses == self.pauses:
+                return
 
 
-def retrieve_factor_returns(factors: dict, start_date: str, end_date: str, frequency='M'):
+def get_retry_delay(attempt, retry_after=None, base_delay=0.5, max_delay=60.0):
     """
-    Function to retrieve factor prices from yahoo finance and return a dataframe of factor returns
-    :param factors:
-    :param start_date:
-    :param end_date:
-    :param frequency:
-    :return:
+    Function to compute how long to wait before retrying a request.
+    :param attempt: int. Number of attempts already made, starting at 0.
+    :param retry_after: string. Retry-After header of the response, in seconds or as an HTTP date.
+    :param base_delay: float. Delay of the first retry, in seconds.
+    :param max_delay: float. Maximum delay, in seconds.
+    :return: float. The Retry-After delay when the data provider sent one, otherwise a jittered exponential backoff.
+    """
+
+    if retry_after:
+        try:
+            return min(max_delay, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+            return min(max_delay, max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds()))
+        except (TypeError, ValueError):
+            pass
+
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class FetchClient:
+    """
+    Connection pool shared by every request to the data provider.
+    An event loop runs on a daemon thread and owns a single aiohttp session, so that TCP connections and
+    TLS sessions are kept alive between symbols, batches and callers on different threads.
+    Responses are requested gzip or deflate compressed, and requests are rate limited to the provider's quota.
+    Identical requests made at the same time share a single download, see async_get_prices.
+    The price and return panels built from the downloads are kept in memory, see async_get_price_panel,
+    together with their trading calendars, see get_trading_calendar.
     """
 
-    df_prices = pd.DataFrame()
+    def __init__(self, max_connections=max_connections, requests_per_minute=requests_per_minute):
+        self.max_connections = max_connections
+        self.limiter = TokenBucket(requests_per_minute / 60)
+        self.in_flight = {}
+        self.panels = {}
+        self.calendars = {}
+        self.session = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='fetch-client', daemon=True)
+
+        # lets the code running on the event loop find its client, see current_fetch_client
+        self.thread.fetch_client = self
+        self.thread.start()
+
+    def get_session(self):
+        """
+        Return the shared aiohttp session, creating it on first use. Must be called from the client's event loop.
+        """
+
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                ssl=ssl_context,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                headers={'Accept-Encoding': 'gzip, deflate'},
+                timeout=aiohttp.ClientTimeout(total=60)
+            )
+
+        return self.session
+
+    def run(self, coroutine):
+        """
+        Run ``coroutine`` on the client's event loop and wait for its result from synchronous code.
+        """
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def run_async(self, coroutine):
+        """
+        Await ``coroutine`` on the client's event loop from any event loop.
+        """
+
+        if asyncio.get_running_loop() is self.loop:
+            return await coroutine
+
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self.loop))
+
+
+def get_fetch_client():
+    """
+    Return the FetchClient shared by the whole process, creating it on first use.
+    """
 
-    for factor in list(factors.values()):
-        df_temp = get_stock_prices(factor, start_date, end_date)[['adjusted_close']]
+    global fetch_client
 
-        # convert the index to datetime
-        df_temp.index = pd.to_datetime(df_temp.index)
+    with fetch_client_lock:
+        if fetch_client is None:
+            fetch_client = FetchClient()
 
-        # add the prices to df_prices
-        df_prices = pd.concat([df_prices, df_temp], axis=1)
+    return fetch_client
 
-    # calculate the percent change based on the desired frequency
-    match frequency:
-        case 'D':
-            df_returns = df_prices.pct_change().dropna()
 
-        case 'M':
-            df_returns = df_prices.resample('M').last().pct_change().dropna()
+def current_fetch_client():
+    """
+    Return the FetchClient whose event loop is running the calling code, otherwise the shared client.
+    """
 
-    # rename the columns
-    df_returns.columns = list(factors.keys())
+    return getattr(threading.current_thread(), 'fetch_client', None) or get_fetch_client()
 
-    print(f'All factors successfully retrieved')
 
-    return df_returns
+def run_sync(coroutine):
+    """
+    Run ``coroutine`` to completion on the shared FetchClient from synchronous code and return its result.
+    Works whether or not an event loop is already running in the calling thread (e.g. Jupyter).
+    """
 
+    return current_fetch_client().run(coroutine)
 
-def regression_vif(X):
-    # values above 5 indicate high correlation between factors
-    # Calculating VIF
-    X = add_constant(X)
-    vif = pd.DataFrame()
-    vif['variables'] = X.columns
-    vif['VIF'] = [variance_inflation_factor(X.values, i) for i in range(X.shape[1])]
 
-    return vif
+def new_fetch_report():
+    """
+    Empty report of the symbols throttled or retried during a run, with the number of times for each symbol.
+    """
 
+    return {'throttled': {}, 'retried': {}}
 
-def linear_reg(y, x, add_const=False):
-    '''
-    Calculates simple and multiple regression model using statsmodels.
-    adds constant to dependent variables automatically.
 
-    Parameters
-    ----------
-    y : DataFrame
-        dependent variable
-    x : DataFrame
-        independent variables
+def print_fetch_report(report):
+    """
+    Print the symbols that were throttled or retried during a run, if any.
+    """
 
-    Returns
-    -------
-    statsmodels regression object
+    for key in ('throttled', 'retried'):
+        if report[key]:
+            counts = ', '.join(f'{symbol} ({count})' for symbol, count in report[key].items())
+            print(f'{key.capitalize()} symbols: {counts}')
 
-    '''
-    if add_const:
-        x = x.copy()
 
-    x = add_constant(x.values)
+async def async_fetch_url(url, symbol, semaphore=None, report=None):
+    """
+    Coroutine downloading ``url`` within the rate limit of the shared FetchClient.
+    Throttled, server error and dropped requests are retried after the Retry-After delay sent by the
+    data provider, or after a jittered exponential backoff. A throttled request holds back every other request.
+    :param url: string.
+    :param symbol: string. Symbol the url belongs to, used in the report.
+    :param semaphore: asyncio.Semaphore. Optional limit on the number of requests in flight.
+    :param report: dict. Optional report from new_fetch_report, updated with the throttled and retried symbols.
+    :return: bytes. The response content.
+    """
+
+    client = current_fetch_client()
+    session = client.get_session()
 
-    lm = OLS(y, x).fit()
+    for attempt in range(max_retries + 1):
+        await client.limiter.acquire()
+        retry_after = None
 
-    return lm
+        try:
+            async with semaphore or nullcontext():
+                async with session.get(url) as response:
+                    if response.status not in retry_statuses or attempt == max_retries:
+                        response.raise_for_status()
+                        return await response.read()
+
+                    status = response.status
+                    retry_after = response.headers.get('Retry-After')
+
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+            if attempt == max_retries:
+                raise
+
+            status = None
+
+        delay = get_retry_delay(attempt, retry_after)
+
+        if status == 429:
+            client.limiter.pause(delay)
 
+        if report is not None:
+            key = 'throttled' if status == 429 else 'retried'
+            report[key][symbol] = report[key].get(symbol, 0) + 1
 
-def multiple_lin_reg(returns, factor_returns, add_const=False):
+        await asyncio.sleep(delay)
+
+
+class PriceProvider(Protocol):
     """
-    Function to compute regular OLS regression on a group of supplied returns
-    :param tickers:
-    :param factors:
-    :param add_const:
-    :return:
+    Interface of a data provider. Implement it to retrieve prices from another vendor than EOD Historical Data.
+    fetch_many receives a whole universe at once, so that providers with bulk endpoints can serve it in one call.
+    The local price store, the delta requests and the request coalescing of async_get_prices work for every provider.
     """
 
-    df_results = pd.DataFrame()
+    # name of the provider in the local price store
+    vendor: str
 
-    for ticker in returns:
-        lin_reg = linear_reg(returns[ticker], factor_returns, True)
-        df_results = pd.concat([df_results, lin_reg.params], axis=1)
+    # False when the prices are already local and must not be copied to the price store
+    cacheable: bool
+
+    async def fetch_many(self, symbols, start_date, end_date, fields, report=None):
+        """
+        Coroutine retrieving ``fields`` of every symbol between start_date and end_date.
+        :return: tuple(dict, dict). Price DataFrames indexed by date and keyed by symbol,
+        and the exception raised for each failed symbol.
+        """
+        ...
+
+
+class EODProvider:
+    """
+    EOD Historical Data. Symbols are requested concurrently through the shared FetchClient, and short
+    date ranges of large universes, e.g. a nightly refresh, are served by the bulk last-day endpoint.
+    The prices of another server than EOD's, e.g. the stand-in of eod_stub_server.py, are cached under their own
+    vendor, named after the server unless ``vendor`` is given.
+    """
+
+    cacheable = True
+
+    def __init__(self, api_key=None, base_url=eod_base_url, max_workers=max_workers,
+                 fmt=None, bulk_cost=100, bulk_max_days=5, vendor=None):
+        self.api_key = api_key or eod_api_key
+
+        if not self.api_key:
+            raise ValueError('No EOD Historical Data API key, set EOD_API_KEY or pass api_key')
+
+        self.base_url = base_url
+        self.max_workers = max_workers
+        self.fmt = fmt or eod_format
+
+        if vendor is None and base_url != eod_base_url:
+            vendor = 'eod-' + re.sub(r'[^\w.-]+', '_', base_url.split('://')[-1]).strip('_')
+
+        self.vendor = vendor or 'eod'
+
+        # a bulk request is billed as 100 requests by EOD, only use it when it replaces more requests than that
+        self.bulk_cost = bulk_cost
+        self.bulk_max_days = bulk_max_days
+
+    def get_ticker(self, symbol):
+        """
+        EOD ticker of ``symbol``, US listings are suffixed with '.US'.
+        """
+
+        if '.TO' not in symbol:
+            return symbol + '.US'
+
+        return symbol
+
+    def get_url(self, symbol, start_date, end_date):
+        """
+        Build the url returning the daily prices of ``symbol``.
+        """
+
+        return f'{self.base_url}/api/eod/{self.get_ticker(symbol)}?from={start_date}&to={end_date}&' \
+               f'period=d&api_token={self.api_key}&fmt={self.fmt}'
+
+    def get_bulk_url(self, exchange, codes, day):
+        """
+        Build the url returning the bar of ``day`` for every code listed on ``exchange``.
+        """
+
+        return f'{self.base_url}/api/eod-bulk-last-day/{exchange}?date={day}&symbols={",".join(codes)}&' \
+               f'api_token={self.api_key}&fmt=json'
+
+    async def fetch(self, symbol, start_date, end_date, fields, semaphore=None, report=None):
+        """
+        Coroutine retrieving the prices of a single symbol.
+        """
+
+        data = await async_fetch_url(self.get_url(symbol, start_date, end_date), symbol, semaphore, report)
+
+        return parse_eod_prices(data, fields, self.fmt)
+
+    async def fetch_many(self, symbols, start_date, end_date, fields=price_fields, report=None):
+        """
+        Coroutine retrieving the prices of several symbols, see PriceProvider.
+        """
+
+        days = pd.bdate_range(start_date, min(end_date, date.today().isoformat()))
+        n_exchanges = len({self.get_ticker(symbol).rsplit('.', 1)[1] for symbol in symbols})
+
+        # one bulk request per exchange and day replaces one request per symbol
+        if 0 < len(days) <= self.bulk_max_days and len(symbols) > self.bulk_cost * len(days) * n_exchanges:
+            prices, missing = await self.fetch_bulk(symbols, days, fields, report)
+        else:
+            prices, missing = {}, symbols
+
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        results = await asyncio.gather(
+            *[self.fetch(symbol, start_date, end_date, fields, semaphore, report) for symbol in missing],
+            return_exceptions=True
+        )
+
+        missing_prices, errors = split_results(missing, results)
+        prices.update(missing_prices)
+
+        return prices, errors
+
+    async def fetch_bulk(self, symbols, days, fields, report=None):
+        """
+        Coroutine retrieving a few days of prices with one bulk request per exchange and day.
+        :return: tuple(dict, list). Price DataFrames keyed by symbol, and the symbols that are missing
+        from a bulk response or whose bulk request failed, to be requested one by one.
+        """
+
+        listings = {}
+
+        for symbol in symbols:
+            code, exchange = self.get_ticker(symbol).rsplit('.', 1)
+            listings.setdefault(exchange, {})[code] = symbol
+
+        requests = [(exchange, day.strftime('%Y-%m-%d')) for exchange in listings for day in days]
+
+        results = await asyncio.gather(
+            *[async_fetch_url(self.get_bulk_url(exchange, listings[exchange], day), f'{exchange} {day}', None, report)
+              for exchange, day in requests],
+            return_exceptions=True
+        )
+
+        rows = {symbol: [] for symbol in symbols}
+        missing = set()
+
+        for (exchange, day), result in zip(requests, results):
+            if isinstance(result, Exception):
+                missing.update(listings[exchange].values())
+                continue
+
+            received = set()
+
+            for row in json.loads(result):
+                symbol = listings[exchange].get(row['code'])
+
+                if symbol is not None:
+                    rows[symbol].append(row)
+                    received.add(symbol)
+
+            missing.update(set(listings[exchange].values()) - received)
+
+        prices = {}
+
+        for symbol in symbols:
+            if symbol in missing:
+                continue
+
+            df_temp = pd.DataFrame(rows[symbol], columns=['date', *fields])
+            df_temp = df_temp.set_index(pd.DatetimeIndex(df_temp.pop('date'), name='date')).astype(np.float64)
+
+            # a bulk request on a holiday returns the previous bar again
+            prices[symbol] = df_temp[~df_temp.index.duplicated(keep='last')].sort_index()
+
+        return prices, [symbol for symbol in symbols if symbol in missing]
+
+
+class LocalFileProvider:
+    """
+    Prices saved as one Parquet or CSV file per symbol in ``directory``, e.g. exported from another vendor.
+    Each file needs a 'date' column and the requested price columns.
+    """
+
+    cacheable = False
+
+    def __init__(self, directory, vendor='local'):
+        self.directory = directory
+        self.vendor = vendor
+
+    def read(self, symbol, start_date, end_date, fields):
+        """
+        Read the prices of a single symbol.
+        """
+
+        path = os.path.join(self.directory, f'{symbol}.parquet')
+
+        if os.path.exists(path):
+            prices = pd.read_parquet(path, columns=['date', *fields])
+        else:
+            prices = pd.read_csv(os.path.join(self.directory, f'{symbol}.csv'), usecols=['date', *fields])
+
+        prices = prices.set_index(pd.DatetimeIndex(prices.pop('date'), name='date')).sort_index()
+
+        return prices.loc[start_date:end_date]
+
+    async def fetch_many(self, symbols, start_date, end_date, fields=price_fields, report=None):
+        """
+        Coroutine reading the prices of several symbols, see PriceProvider.
+        """
+
+        prices = {}
+        errors = {}
+
+        for symbol in symbols:
+            try:
+                prices[symbol] = self.read(symbol, start_date, end_date, fields)
+            except Exception as e:
+                errors[symbol] = e
+
+        return prices, errors
+
+
+def split_results(symbols, results):
+    """
+    Split the results of asyncio.gather(..., return_exceptions=True) into prices and errors keyed by symbol.
+    """
+
+    prices = {}
+    errors = {}
+
+    for symbol, result in zip(symbols, results):
+        if isinstance(result, Exception):
+            errors[symbol] = result
+        else:
+            prices[symbol] = result
+
+    return prices, errors
+
+
+async def async_load_prices(provider, symbols, start_date, end_date, fields, futures, report=None):
+    """
+    Coroutine reading the prices of several symbols from the local price store, and requesting the missing
+    dates from ``provider``. Symbols missing the same dates are requested together with one fetch_many call.
+    Symbols whose history was adjusted since it was cached are requested again for the whole date range.
+    The columns already cached are requested with ``fields``, so that the store keeps every column.
+    The price store is read and written on worker threads, so that it does not hold up the event loop shared by
+    every caller. Called through async_get_prices.
+    :param provider: PriceProvider.
+    :param symbols: list[strings].
+    :param start_date: string.
+    :param end_date: string.
+    :param fields: list[strings]. Price columns to return.
+    :param futures: dict. Future of each symbol, resolved with its prices or its exception.
+    :param report: dict. Optional report from new_fetch_report, updated with the throttled and retried symbols.
+    :return: None
+    """
+
+    cached = dict.fromkeys(symbols)
+    requests = {}
+
+    if provider.cacheable:
+        stored = await asyncio.gather(
+            *[asyncio.to_thread(read_cached_prices, provider.vendor, symbol) for symbol in symbols]
+        )
+        cached.update(zip(symbols, stored))
+
+    for symbol in symbols:
+        prices = select_cached_prices(cached[symbol], start_date, end_date, fields)
+
+        if prices is not None:
+            futures[symbol].set_result(prices)
+        else:
+            requests.setdefault(get_delta_request(cached[symbol], start_date, end_date, fields), []).append(symbol)
+
+    while requests:
+        results = await asyncio.gather(
+            *[provider.fetch_many(group, fetch_start, fetch_end, fetch_fields, report)
+              for (fetch_start, fetch_end, fetch_fields), group in requests.items()]
+        )
+        adjusted = {}
+        writes = {}
+
+        for ((fetch_start, fetch_end, fetch_fields), group), (prices, errors) in zip(requests.items(), results):
+            for symbol in group:
+                if symbol in errors:
+                    futures[symbol].set_exception(errors[symbol])
+                    continue
+
+                if provider.cacheable:
+                    if is_history_adjusted(cached[symbol], prices[symbol], fetch_start):
+                        # the cached bars are stale, they are replaced by the full history
+                        adjusted.setdefault((start_date, end_date, fetch_fields), []).append(symbol)
+                        cached[symbol] = None
+                        continue
+
+                    writes[symbol] = asyncio.to_thread(
+                        write_cached_prices, provider.vendor, symbol, prices[symbol], fetch_start, fetch_end,
+                        cached[symbol]
+                    )
+                    continue
+
+                futures[symbol].set_result(prices[symbol].loc[start_date:end_date, list(fields)])
+
+        for symbol, merged in zip(writes, await asyncio.gather(*writes.values())):
+            futures[symbol].set_result(merged.loc[start_date:end_date, list(fields)])
+
+        requests = adjusted
+
+
+async def async_get_prices(symbols: list, start_date, end_date, max_workers=max_workers, fields=price_fields,
+                           report=None, provider=None):
+    """
+    Coroutine retrieving the prices of several symbols on the event loop of the shared FetchClient.
+    Prices are read from the local price store when it covers the requested dates, otherwise only the dates
+    after the last cached bar are requested. Concurrent calls for the same symbol, dates and fields, e.g. from
+    several app sessions or a fund that is also a factor, wait on one request and share the resulting DataFrame,
+    which must not be modified in place.
+    The symbols that were throttled or retried are printed at the end of the run.
+    :param symbols: list[strings]. Symbols to retrieve. Duplicates are only requested once.
+    :param start_date: string.
+    :param end_date: string.
+    :param max_workers: int. Maximum number of requests in flight at the same time for the default provider.
+    :param fields: list[strings]. Price columns to return.
+    :param report: dict. Optional report from new_fetch_report, updated with the throttled and retried symbols.
+    :param provider: PriceProvider. Defaults to EODProvider.
+    :return: tuple(dict, dict). Price DataFrames keyed by symbol, and the exception raised for each failed symbol.
+    """
+
+    client = current_fetch_client()
+
+    if asyncio.get_running_loop() is not client.loop:
+        return await client.run_async(
+            async_get_prices(symbols, start_date, end_date, max_workers, fields, report, provider)
+        )
+
+    if provider is None:
+        provider = EODProvider(max_workers=max_workers)
+
+    if report is None:
+        report = new_fetch_report()
+
+    symbols = list(dict.fromkeys(symbols))
+    futures = {}
+    to_load = []
+
+    for symbol in symbols:
+        key = (provider.vendor, symbol, start_date, end_date, tuple(fields))
+        future = client.in_flight.get(key)
+
+        if future is None:
+            future = client.loop.create_future()
+            client.in_flight[key] = future
+            future.add_done_callback(lambda _, key=key: client.in_flight.pop(key, None))
+            to_load.append(symbol)
+
+        futures[symbol] = future
+
+    if to_load:
+        try:
+            await async_load_prices(provider, to_load, start_date, end_date, fields, futures, report)
+        except BaseException as e:
+            for symbol in to_load:
+                if not futures[symbol].done():
+                    futures[symbol].set_exception(e)
+            raise
+
+    # a cancelled caller must not cancel the requests shared with the other callers
+    results = await asyncio.gather(*[asyncio.shield(futures[symbol]) for symbol in symbols], return_exceptions=True)
+
+    print_fetch_report(report)
+
+    return split_results(symbols, results)
+
+
+async def async_get_stock_prices(symbol, start_date, end_date, fields=price_fields, provider=None):
+    """
+    Coroutine version of get_stock_prices.
+    :param symbol: string.
+    :param start_date: string.
+    :param end_date: string.
+    :param fields: list[strings]. Price columns to return.
+    :param provider: PriceProvider. Defaults to EODProvider.
+    :return: pd.DataFrame
+    """
+
+    prices, errors = await async_get_prices([symbol], start_date, end_date, fields=fields, provider=provider)
+
+    if errors:
+        raise errors[symbol]
+
+    return prices[symbol]
+
+
+def get_stock_prices(symbol, start_date, end_date, fields=price_fields, provider=None):
+    """
+    Receive the content of ``url``, parse it and return the requested price columns.
+    Prices are read from the local price store when it covers the requested dates,
+    otherwise only the dates after the last cached bar are requested.
+    """
+
+    return run_sync(async_get_stock_prices(symbol, start_date, end_date, fields, provider))
+
+
+def get_prices_concurrent(symbols: list, start_date, end_date, max_workers=max_workers, fields=price_fields,
+                          report=None, provider=None):
+    """
+    Function to retrieve the prices of several symbols in parallel with a bounded number of requests in flight.
+    A failure on one symbol does not stop the retrieval of the others.
+    :param symbols: list[strings]. Symbols to retrieve. Duplicates are only requested once.
+    :param start_date: string.
+    :param end_date: string.
+    :param max_workers: int. Maximum number of requests in flight at the same time for the default provider.
+    :param fields: list[strings]. Price columns to return.
+    :param report: dict. Optional report from new_fetch_report, updated with the throttled and retried symbols.
+    :param provider: PriceProvider. Defaults to EODProvider.
+    :return: tuple(dict, dict). Price DataFrames keyed by symbol, and the exception raised for each failed symbol.
+    """
+
+    return run_sync(async_get_prices(symbols, start_date, end_date, max_workers, fields, report, provider))
+
+
+def raise_for_errors(errors: dict):
+    """
+    Raise an exception listing every symbol that could not be retrieved by get_prices_concurrent.
+    :param errors: dict. Exceptions keyed by symbol.
+    :return: None
+    """
+
+    if not errors:
+        return
+
+    for symbol, error in errors.items():
+        # request errors include the url, keep the API key of any provider out of the logs
+        message = re.sub(r'api_token=[^&\s\'"]*', 'api_token=<api_token>', f'{type(error).__name__}: {error}')
+        print(f'Unable to retrieve {symbol}: {message}')
+
+    # the request errors are not chained, their traceback would print the url with the API key
+    raise RuntimeError(f'Unable to retrieve prices for {", ".join(errors)}') from None
+
+
+def build_price_panel(prices: dict, symbols: list, field='adjusted_close', dtype=np.float64):
+    """
+    Function to combine one price field of ``symbols`` into a single DataFrame in one pass.
+    The union calendar is computed once and every symbol is scattered into a preallocated array,
+    instead of re-aligning and copying the whole panel for each symbol.
+    :param prices: dict. Price DataFrames keyed by symbol, as returned by get_prices_concurrent.
+    :param symbols: list[strings]. Symbols to include, in column order.
+    :param field: string. Price column to use.
+    :param dtype: np.dtype. Type of the panel.
+    :return: pd.DataFrame. Prices indexed by the union of all dates, NaN where a symbol has no price.
+    """
+
+    dates = [prices[symbol].index.values.astype('datetime64[ns]') for symbol in symbols]
+    calendar = np.unique(np.concatenate(dates)) if dates else np.array([], dtype='datetime64[ns]')
+
+    panel = np.full((len(calendar), len(symbols)), np.nan, dtype=dtype)
+
+    for column, (symbol, symbol_dates) in enumerate(zip(symbols, dates)):
+        panel[np.searchsorted(calendar, symbol_dates), column] = prices[symbol][field].to_numpy()
+
+    return pd.DataFrame(panel, index=pd.DatetimeIndex(calendar, name='date'), columns=symbols)
+
+
+def get_period_end_positions(dates, frequency='M'):
+    """
+    Function to find the row of the last trading day of every period in ``dates``.
+    :param dates: pd.DatetimeIndex. Sorted trading days.
+    :param frequency: string. 'D' for daily, 'W' for weekly, 'M' for monthly, 'Q' for quarterly.
+    :return: np.ndarray. Row positions, one per period.
+    """
+
+    if frequency not in return_frequencies:
+        raise ValueError(f'Unsupported frequency {frequency}, use one of {", ".join(return_frequencies)}')
+
+    if frequency == 'D' or len(dates) == 0:
+        return np.arange(len(dates))
+
+    periods = dates.to_period(frequency).asi8
+
+    return np.append(np.flatnonzero(periods[1:] != periods[:-1]), len(dates) - 1)
+
+
+class TradingCalendar:
+    """
+    Trading days of a price panel with the row of the last trading day of every period, computed once for
+    every frequency in return_frequencies. Resampling a panel is then a single row gather, see resample.
+    Calendars are shared between calls through get_trading_calendar.
+    """
+
+    def __init__(self, dates):
+        self.dates = pd.DatetimeIndex(dates)
+        self.period_ends = {}
+        self.period_labels = {}
+
+        for frequency in return_frequencies:
+            positions = get_period_end_positions(self.dates, frequency)
+            labels = self.dates[positions]
+
+            # periods are labelled by their end date, like resample
+            if frequency != 'D':
+                labels = labels.to_period(frequency).to_timestamp(how='end').normalize()
+
+            self.period_ends[frequency] = positions
+            self.period_labels[frequency] = labels
+
+    def __len__(self):
+        return len(self.dates)
+
+    def get_positions(self, frequency='M'):
+        """
+        Return the row positions of the last trading day of every period.
+        """
+
+        if frequency not in self.period_ends:
+            raise ValueError(f'Unsupported frequency {frequency}, use one of {", ".join(return_frequencies)}')
+
+        return self.period_ends[frequency]
+
+    def resample(self, values, frequency='M'):
+        """
+        Return the rows of ``values``, a (date x symbol) array on this calendar, at the end of every period.
+        :return: tuple(np.ndarray, pd.DatetimeIndex). The gathered rows and their period labels.
+        """
+
+        return values[self.get_positions(frequency)], self.period_labels[frequency]
+
+
+def get_trading_calendar(dates):
+    """
+    Return the TradingCalendar of ``dates``, from the FetchClient's cache when the same dates were seen before.
+    """
+
+    client = current_fetch_client()
+    dates = pd.DatetimeIndex(dates)
+    key = hash(dates.asi8.tobytes())
+
+    calendar = client.calendars.get(key)
+
+    if calendar is None or not calendar.dates.equals(dates):
+        calendar = TradingCalendar(dates)
+        client.calendars[key] = calendar
+
+        # keep the calendars of the most recent universes only
+        for cached_key in list(client.calendars)[:-max_cached_panels]:
+            del client.calendars[cached_key]
+
+    return calendar
+
+
+def calculate_period_returns(df_prices, frequency='M', dropna=True, dtype=None, block_size=256):
+    """
+    Function to calculate the returns of a forward filled daily price panel at the desired frequency.
+    The prices are sampled at the last trading day of every period, like resample(frequency).last(),
+    and the periods are labelled by their end date.
+    The returns are calculated in float64 over blocks of ``block_size`` symbols and written to a preallocated
+    array, so that a float32 panel is never converted as a whole.
+    :param df_prices: pd.DataFrame. Daily prices without gaps after the first price of each symbol.
+    :param frequency: string. 'D' for daily, 'W' for weekly, 'M' for monthly, 'Q' for quarterly.
+    :param dropna: bool. Drop the periods where a symbol has no return yet.
+    :param dtype: np.dtype. Type of the returns, defaults to return_dtype.
+    :param block_size: int. Number of symbols calculated at a time.
+    :return: pd.DataFrame. Returns on the periods where every symbol has one, unless dropna is False.
+    """
+
+    calendar = get_trading_calendar(df_prices.index)
+    positions = calendar.get_positions(frequency)
+    index = calendar.period_labels[frequency]
+
+    values = df_prices.to_numpy()
+    returns = np.empty((max(len(positions) - 1, 0), values.shape[1]), dtype=dtype or return_dtype)
+
+    for start in range(0, values.shape[1], block_size):
+        block = slice(start, start + block_size)
+        prices = values[positions, block].astype(np.float64, copy=False)
+
+        returns[:, block] = prices[1:] / prices[:-1] - 1
+
+    df_returns = pd.DataFrame(returns, index=index[1:], columns=df_prices.columns)
+
+    return df_returns.dropna() if dropna else df_returns
+
+
+def cache_panel(client, key, df):
+    """
+    Store a panel in the client's in-memory cache, dropping the oldest universes beyond max_cached_panels.
+    """
+
+    client.panels[key] = df
+
+    universes = list(dict.fromkeys(cached_key[:4] for cached_key in client.panels))
+
+    for universe in universes[:-max_cached_panels]:
+        for cached_key in [cached_key for cached_key in client.panels if cached_key[:4] == universe]:
+            del client.panels[cached_key]
+
+    return df
+
+
+def drop_incomplete_periods(df_returns):
+    """
+    Function to drop the periods where any symbol has no return, like dropna().
+    The missing returns of a forward filled panel all come before each symbol's first price, in which case
+    the result is a view starting at the first complete period.
+    :param df_returns: pd.DataFrame.
+    :return: pd.DataFrame
+    """
+
+    complete = df_returns.notna().to_numpy().all(axis=1)
+    first = complete.argmax() if complete.any() else len(complete)
+
+    if complete[first:].all():
+        return df_returns.iloc[first:]
+
+    return df_returns.dropna()
+
+
+async def async_get_price_panel(symbols: list, start_date, end_date, provider=None):
+    """
+    Coroutine returning the forward filled daily adjusted close prices of ``symbols``, from memory when the same
+    universe was requested before. The panel is shared with later callers and must not be modified in place.
+    :param symbols: list[strings]. Symbols to include, in column order. Duplicates are only included once.
+    :param start_date: string.
+    :param end_date: string.
+    :param provider: PriceProvider. Defaults to EODProvider.
+    :return: pd.DataFrame
+    """
+
+    client = current_fetch_client()
+    symbols = list(dict.fromkeys(symbols))
+    key = (provider.vendor if provider else 'eod', tuple(symbols), start_date, end_date, np.dtype(return_dtype).name)
+
+    if key in client.panels:
+        return client.panels[key]
+
+    prices, errors = await async_get_prices(symbols, start_date, end_date, provider=provider)
+    raise_for_errors(errors)
+
+    # a missing price is carried forward, as pct_change does
+    return cache_panel(client, key, build_price_panel(prices, symbols, dtype=return_dtype).ffill())
+
+
+async def async_get_period_returns(symbols: list, start_date, end_date, frequency='M', provider=None, dropna=True):
+    """
+    Coroutine returning the returns of ``symbols`` at the desired frequency, derived from the cached daily
+    price panel and cached in turn, so that switching frequency does not download or recalculate anything.
+    The returns are shared with later callers and must not be modified in place.
+    :param symbols: list[strings]. Symbols to include, in column order. Duplicates are only included once.
+    :param start_date: string.
+    :param end_date: string.
+    :param frequency: string. 'D' for daily, 'W' for weekly, 'M' for monthly, 'Q' for quarterly.
+    :param provider: PriceProvider. Defaults to EODProvider.
+    :param dropna: bool. Drop the periods where any symbol has no return. Otherwise every symbol keeps its own
+        history and its returns are NaN before its first price, see masked_ols_params.
+    :return: pd.DataFrame
+    """
+
+    client = current_fetch_client()
+    symbols = list(dict.fromkeys(symbols))
+    key = (provider.vendor if provider else 'eod', tuple(symbols), start_date, end_date, frequency,
+           np.dtype(return_dtype).name)
+
+    if key not in client.panels:
+        # extend the returns of the same universe cached up to an earlier date, rather than starting over
+        earlier = [
+            cached_key for cached_key in client.panels
+            if len(cached_key) == len(key) and cached_key[:3] == key[:3] and cached_key[4:] == key[4:]
+            and pd.Timestamp(cached_key[3]) < pd.Timestamp(end_date) and len(client.panels[cached_key]) > 1
+        ]
+
+        if earlier:
+            cached_key = max(earlier, key=lambda cached_key: pd.Timestamp(cached_key[3]))
+            df_returns, _ = await async_update_period_returns(client.panels[cached_key], end_date, frequency,
+                                                              provider)
+            cache_panel(client, key, df_returns)
+
+        else:
+            df_prices = await async_get_price_panel(symbols, start_date, end_date, provider)
+            cache_panel(client, key, calculate_period_returns(df_prices, frequency, dropna=False))
+
+    df_returns = client.panels[key]
+
+    return drop_incomplete_periods(df_returns) if dropna else df_returns
+
+
+async def async_update_period_returns(df_returns, end_date, frequency='M', provider=None):
+    """
+    Coroutine extending a return panel to end_date by calculating only the periods from its last one onward.
+    The last period is recalculated, in case it was still open, and the new periods are appended, so that a
+    monthly roll costs the new observations rather than the whole history.
+    Only the prices from the start of the second to last period are retrieved.
+    :param df_returns: pd.DataFrame. Returns of at least two periods, one column per symbol, as returned by
+        async_get_period_returns(..., dropna=False).
+    :param end_date: string.
+    :param frequency: string. Frequency of df_returns, 'D', 'W', 'M' or 'Q'.
+    :param provider: PriceProvider. Defaults to EODProvider.
+    :return: tuple(pd.DataFrame, pd.Series). The extended returns, and whether the returns of each symbol changed.
+    """
+
+    if len(df_returns) < 2:
+        raise ValueError('At least two periods of returns are needed to extend a return panel')
+
+    symbols = list(df_returns.columns)
+
+    # the prices at the end of the second to last period are the base of the recalculated last period
+    start_date = df_returns.index[-2].to_period(frequency).start_time.strftime('%Y-%m-%d')
+
+    prices, errors = await async_get_prices(symbols, start_date, end_date, provider=provider)
+    raise_for_errors(errors)
+
+    # the prices are stored like those of the cached returns, so that an unchanged period compares equal
+    dtype = np.result_type(*df_returns.dtypes)
+    df_prices = build_price_panel(prices, symbols, dtype=dtype).ffill()
+    df_new = calculate_period_returns(df_prices, frequency, dropna=False, dtype=dtype)
+    df_new = df_new.loc[df_new.index >= df_returns.index[-1]]
+
+    old = df_returns.iloc[-1:].reindex(df_new.index).to_numpy()
+    new = df_new.to_numpy()
+    changed = ((old != new) & ~(np.isnan(old) & np.isnan(new))).any(axis=0)
+
+    df_returns = pd.concat([df_returns.iloc[:-1], df_new])
+
+    return df_returns, pd.Series(changed, index=df_returns.columns, name='changed')
+
+
+def update_period_returns(df_returns, end_date, frequency='M', provider=None):
+    """
+    Function to extend a return panel to end_date, see async_update_period_returns.
+    :return: tuple(pd.DataFrame, pd.Series). The extended returns, and whether the returns of each symbol changed.
+    """
+
+    return run_sync(async_update_period_returns(df_returns, end_date, frequency, provider))
+
+
+async def async_get_return_panel(tickers: list, factors: dict, start_date, end_date, frequency='M', provider=None,
+                                 dropna=True, excess=False, log=False):
+    """
+    Coroutine retrieving the funds and the factors in one pass and calculating their returns on one calendar.
+    Symbols shared by funds and factors are retrieved once, and the panel is kept in memory for every frequency.
+    :param tickers: list[strings]. Fund tickers.
+    :param factors: dict. Factor names mapped to their ETF symbol.
+    :param start_date: string.
+    :param end_date: string.
+    :param frequency: string. 'D' for daily, 'W' for weekly, 'M' for monthly, 'Q' for quarterly. Default is monthly.
+    :param provider: PriceProvider. Defaults to EODProvider.
+    :param dropna: bool. Keep only the dates where every fund and factor has a return. Otherwise the returns are
+        NaN before each symbol's first price, see masked_ols_params.
+    :param excess: bool. Subtract the returns of risk_free_symbol, see transform_returns.
+    :param log: bool. Log returns instead of simple returns.
+    :return: pd.DataFrame. Fund returns followed by factor returns, on the dates where all of them are available.
+        Shared with later callers, it must not be modified in place.
+    """
+
+    symbols = list(tickers) + list(factors.values())
+
+    df_returns = await async_get_period_returns(symbols, start_date, end_date, frequency, provider, dropna)
+
+    if len(df_returns.columns) < len(symbols):
+        # a fund that is also a factor gets a column of each
+        df_returns = df_returns[symbols]
+
+    # rename the columns, without copying the cached returns
+    df_returns = df_returns.set_axis(list(tickers) + list(factors.keys()), axis=1, copy=False)
+
+    if excess or log:
+        risk_free = await async_get_risk_free_returns(start_date, end_date, frequency, provider) if excess else None
+        df_returns = transform_returns(df_returns, risk_free, log)
+
+    if len(tickers):
+        print('All tickers successfully retrieved')
+
+    if factors:
+        print('All factors successfully retrieved')
+
+    return df_returns
+
+
+async def async_get_risk_free_returns(start_date, end_date, frequency='M', provider=None):
+    """
+    Coroutine returning the returns of risk_free_symbol, from the price store and the in-memory panels once retrieved.
+    :return: pd.Series
+    """
+
+    df_returns = await async_get_period_returns([risk_free_symbol], start_date, end_date, frequency, provider,
+                                                dropna=False)
+
+    return df_returns.iloc[:, 0]
+
+
+def transform_returns(df_returns, risk_free=None, log=False):
+    """
+    Function to convert a panel of simple returns to excess and/or log returns.
+    The panel is copied once and transformed in place with a single broadcast operation for all the columns.
+    :param df_returns: pd.DataFrame. Simple returns.
+    :param risk_free: pd.Series. Simple risk-free returns of the same frequency, subtracted from every column.
+        Dates without a risk-free return are treated as 0.
+    :param log: bool. Return log(1 + r), and log(1 + r) - log(1 + rf) with a risk-free rate.
+    :return: pd.DataFrame
+    """
+
+    returns = df_returns.to_numpy(dtype=np.result_type(*df_returns.dtypes), copy=True)
+
+    if log:
+        np.log1p(returns, out=returns)
+
+    if risk_free is not None:
+        rf = risk_free.reindex(df_returns.index).fillna(0).to_numpy(dtype=returns.dtype)
+
+        if log:
+            np.log1p(rf, out=rf)
+
+        returns -= rf[:, np.newaxis]
+
+    return pd.DataFrame(returns, index=df_returns.index, columns=df_returns.columns, copy=False)
+
+
+def split_return_panel(df_returns, n_funds):
+    """
+    Function to split a return panel from async_get_return_panel into fund and factor returns.
+    Both are views on the panel, no data is copied.
+    :param df_returns: pd.DataFrame.
+    :param n_funds: int. Number of fund columns at the start of the panel.
+    :return: tuple(pd.DataFrame, pd.DataFrame). Fund returns and factor returns.
+    """
+
+    return df_returns.iloc[:, :n_funds], df_returns.iloc[:, n_funds:]
+
+
+async def async_get_returns(tickers: list, start_date, end_date, frequency='M', provider=None, excess=False,
+                            log=False):
+    """
+    Coroutine version of get_returns, to be awaited from an event loop.
+    :param tickers: list[strings]. Tickers supplied as a list.
+    :param start_date: string.
+    :param end_date: string.
+    :param frequency: string. 'D' for daily, 'W' for weekly, 'M' for monthly, 'Q' for quarterly. Default is monthly.
+    :param provider: PriceProvider. Defaults to EODProvider.
+    :param excess: bool. Returns in excess of the risk-free rate.
+    :param log: bool. Log returns instead of simple returns.
+    :return: pd.DataFrame
+    """
+
+    return await async_get_return_panel(tickers, {}, start_date, end_date, frequency, provider, excess=excess, log=log)
+
+
+def get_returns(tickers: list, start_date, end_date, frequency='M', provider=None, excess=False, log=False):
+    """
+    Function to calculate returns based on the supplied prices and frequency.
+    :param tickers: list[strings]. Yahoo finance tickers supplied as a list.
+    :param start_date: string.
+    :param end_date: string.
+    :param frequency: string. 'D' for daily, 'W' for weekly, 'M' for monthly, 'Q' for quarterly. Default is monthly.
+    :param provider: PriceProvider. Defaults to EODProvider.
+    :param excess: bool. Returns in excess of the risk-free rate, see risk_free_symbol.
+    :param log: bool. Log returns instead of simple returns.
+    :return: pd.DataFrame
+    """
+
+    return run_sync(async_get_returns(tickers, start_date, end_date, frequency, provider, excess, log))
+
+
+async def async_retrieve_factor_returns(factors: dict, start_date: str, end_date: str, frequency='M', provider=None,
+                                        excess=False, log=False):
+    """
+    Coroutine version of retrieve_factor_returns, to be awaited from an event loop.
+    :param factors: dict. Factor names mapped to their ETF symbol.
+    :param start_date: string.
+    :param end_date: string.
+    :param frequency: string. 'D' for daily, 'W' for weekly, 'M' for monthly, 'Q' for quarterly. Default is monthly.
+    :param provider: PriceProvider. Defaults to EODProvider.
+    :param excess: bool. Returns in excess of the risk-free rate.
+    :param log: bool. Log returns instead of simple returns.
+    :return: pd.DataFrame
+    """
+
+    return await async_get_return_panel([], factors, start_date, end_date, frequency, provider, excess=excess, log=log)
+
+
+def retrieve_factor_returns(factors: dict, start_date: str, end_date: str, frequency='M', provider=None, excess=False,
+                            log=False):
+    """
+    Function to retrieve factor prices from yahoo finance and return a dataframe of factor returns
+    :param factors:
+    :param start_date:
+    :param end_date:
+    :param frequency:
+    :param provider: PriceProvider. Defaults to EODProvider.
+    :param excess: bool. Returns in excess of the risk-free rate, see risk_free_symbol.
+    :param log: bool. Log returns instead of simple returns.
+    :return:
+    """
+
+    return run_sync(async_retrieve_factor_returns(factors, start_date, end_date, frequency, provider, excess, log))
+
+
+async def async_get_all_returns(tickers: list, factors: dict, start_date: str, end_date: str, frequency='M',
+                                provider=None, dropna=True, excess=False, log=False):
+    """
+    Coroutine retrieving the fund and the factor returns aligned on one calendar.
+    :param tickers: list[strings]. Fund tickers.
+    :param factors: dict. Factor names mapped to their ETF symbol.
+    :param start_date: string.
+    :param end_date: string.
+    :param frequency: string. 'D' for daily, 'W' for weekly, 'M' for monthly, 'Q' for quarterly. Default is monthly.
+    :param provider: PriceProvider. Defaults to EODProvider.
+    :param dropna: bool. Keep only the dates where every fund and factor has a return. Otherwise every fund keeps
+        its own history, to be regressed with masked_ols_params. Only the young funds gain dates from it, a young
+        factor still shortens every fund's window, unless it is left out with omit_factors=True.
+    :param excess: bool. Returns in excess of the risk-free rate, see risk_free_symbol.
+    :param log: bool. Log returns instead of simple returns.
+    :return: tuple(pd.DataFrame, pd.DataFrame). Fund returns and factor returns, views on one return panel.
+    """
+
+    df_returns = await async_get_return_panel(tickers, factors, start_date, end_date, frequency, provider, dropna,
+                                              excess, log)
+
+    return split_return_panel(df_returns, len(tickers))
+
+
+def write_return_store(path, df_returns, frequency=None):
+    """
+    Function to save a return panel as a return store, see ReturnStore.
+    The returns are written column by column to a Fortran ordered .npy file, so that the history of one symbol
+    and any range of dates are contiguous slices of the memory-mapped file.
+    Each version of the returns is a new file named by index.json, and replacing index.json swaps the returns and
+    their indexes at once, so that readers see either the previous or the new store.
+    :param path: string. Directory of the store, created if needed. An existing store is replaced.
+    :param df_returns: pd.DataFrame. Returns indexed by date, one column per symbol, float32 or float64.
+    :param frequency: string. Frequency of the returns, kept with the indexes.
+    :return: ReturnStore
+    """
+
+    os.makedirs(path, exist_ok=True)
+
+    fd, returns_path = tempfile.mkstemp(dir=path, prefix='returns-', suffix='.npy')
+    os.close(fd)
+
+    index = {
+        'symbols': [str(symbol) for symbol in df_returns.columns],
+        'dates': [f'{day:%Y-%m-%d}' for day in df_returns.index],
+        'frequency': frequency,
+        'returns': os.path.basename(returns_path),
+    }
+
+    try:
+        dtype = np.float32 if all(dtype == np.float32 for dtype in df_returns.dtypes) else np.float64
+        returns = np.lib.format.open_memmap(returns_path, mode='w+', dtype=dtype, shape=df_returns.shape,
+                                            fortran_order=True)
+
+        for column in range(df_returns.shape[1]):
+            returns[:, column] = df_returns.iloc[:, column].to_numpy(dtype=dtype)
+
+        returns.flush()
+        del returns
+
+        fd, index_path = tempfile.mkstemp(dir=path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+
+        # the only step readers can observe
+        os.replace(index_path, os.path.join(path, 'index.json'))
+    except BaseException:
+        os.remove(returns_path)
+        raise
+
+    # remove the previous versions, a file still mapped by a reader on Windows is removed by the next write
+    for name in os.listdir(path):
+        if name.startswith('returns') and name.endswith('.npy') and name != index['returns']:
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+
+    return ReturnStore(path)
+
+
+class ReturnStore:
+    """
+    Read-only return panel memory-mapped from disk, for universes too large to rebuild in every process.
+    The returns are a (date x symbol) float matrix in a .npy file named by index.json, with the symbols and dates.
+    Every process opening the same store shares one page-cached copy, and the lookups return views of the
+    file rather than copies wherever the selection is a range. Create a store with write_return_store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        for attempt in range(3):
+            with open(os.path.join(path, 'index.json')) as f:
+                index = json.load(f)
+
+            try:
+                self.returns = np.load(os.path.join(path, index['returns']), mmap_mode='r')
+                break
+            except FileNotFoundError:
+                # the store was replaced since index.json was read
+                if attempt == 2:
+                    raise
+
+        self.symbols = pd.Index(index['symbols'], name='symbol')
+        self.dates = pd.DatetimeIndex(index['dates'], name='date')
+        self.frequency = index['frequency']
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def __contains__(self, symbol):
+        return symbol in self.symbols
+
+    def get_rows(self, start_date=None, end_date=None):
+        """
+        Return the slice of rows between start_date and end_date, both included.
+        """
+
+        return self.dates.slice_indexer(start_date, end_date)
+
+    def get_columns(self, symbols=None):
+        """
+        Return the columns of ``symbols``, as a slice when they are stored next to each other in the same order.
+        """
+
+        if symbols is None:
+            return slice(None)
+
+        positions = self.symbols.get_indexer(symbols)
+
+        if (positions < 0).any():
+            missing = [symbol for symbol, position in zip(symbols, positions) if position < 0]
+            raise KeyError(f'Symbols not in the return store: {", ".join(missing)}')
+
+        if len(positions) and (np.diff(positions) == 1).all():
+            return slice(positions[0], positions[-1] + 1)
+
+        return positions
+
+    def get_series(self, symbol, start_date=None, end_date=None):
+        """
+        Return the returns of one symbol between start_date and end_date, a view of the file.
+        :return: np.ndarray
+        """
+
+        return self.returns[self.get_rows(start_date, end_date), self.symbols.get_loc(symbol)]
+
+    def get_array(self, symbols=None, start_date=None, end_date=None):
+        """
+        Return the (date x symbol) returns of ``symbols`` between start_date and end_date.
+        A view of the file when ``symbols`` is None or a range of stored symbols, otherwise a copy of the selection.
+        :return: np.ndarray
+        """
+
+        return self.returns[self.get_rows(start_date, end_date), self.get_columns(symbols)]
+
+    def get_returns(self, symbols=None, start_date=None, end_date=None):
+        """
+        Return the returns of ``symbols`` between start_date and end_date as a DataFrame on top of get_array.
+        :return: pd.DataFrame
+        """
+
+        rows, columns = self.get_rows(start_date, end_date), self.get_columns(symbols)
+
+        return pd.DataFrame(self.returns[rows, columns], index=self.dates[rows], columns=self.symbols[columns],
+                            copy=False)
+
+
+def build_return_store(path, symbols: list, start_date, end_date, frequency='D', provider=None):
+    """
+    Function to retrieve the prices of ``symbols``, calculate their returns and save them as a return store.
+    Symbols are kept on their own history, a symbol's returns are NaN before its first price.
+    :param path: string. Directory of the store.
+    :param symbols: list[strings].
+    :param start_date: string.
+    :param end_date: string.
+    :param frequency: string. 'D' for daily, 'W' for weekly, 'M' for monthly, 'Q' for quarterly. Default is daily.
+    :param provider: PriceProvider. Defaults to EODProvider.
+    :return: ReturnStore
+    """
+
+    prices, errors = get_prices_concurrent(symbols, start_date, end_date, provider=provider)
+    raise_for_errors(errors)
+
+    df_prices = build_price_panel(prices, list(dict.fromkeys(symbols)), dtype=return_dtype).ffill()
+
+    # keep every period instead of dropping the ones where a symbol has no price yet
+    df_returns = calculate_period_returns(df_prices, frequency, dropna=False)
+
+    return write_return_store(path, df_returns, frequency)
+
+
+def save_return_panels(path, df_funds, df_factors, frequency=None, factors=None, vendor='eod', **metadata):
+    """
+    Function to save aligned fund and factor returns, e.g. from async_get_all_returns, for other jobs and the app.
+    The panels are written as one Arrow table: a date column, the calendar, and a returns column holding every
+    fund and factor return of a date as one fixed size list, so that the file is one contiguous (date x symbol)
+    matrix that load_return_panels maps back to numpy without copying.
+    A path ending in .parquet writes Parquet instead of the Arrow IPC file, smaller but decoded when loaded.
+    :param path: string.
+    :param df_funds: pd.DataFrame. Fund returns.
+    :param df_factors: pd.DataFrame. Factor returns on the same dates.
+    :param frequency: string. Frequency of the returns.
+    :param factors: dict. Factor names mapped to their ETF symbol, kept with the universe.
+    :param vendor: string. Data provider of the prices.
+    :param metadata: Other JSON serializable values kept in the metadata, e.g. start_date, excess and log.
+    :return: dict. The metadata written to the schema.
+    """
+
+    if not df_funds.index.equals(df_factors.index):
+        raise ValueError('The fund and factor returns must be on the same dates')
+
+    dtype = np.result_type(*df_funds.dtypes, *df_factors.dtypes)
+    returns = np.hstack([df_funds.to_numpy(dtype=dtype), df_factors.to_numpy(dtype=dtype)])
+
+    metadata = {
+        'frequency': frequency,
+        'vendor': vendor,
+        'as_of': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'tickers': [str(ticker) for ticker in df_funds.columns],
+        'factors': factors or {str(name): str(name) for name in df_factors.columns},
+        'factor_names': [str(name) for name in df_factors.columns],
+        **metadata,
+    }
+
+    table = pa.table(
+        {
+            'date': pa.array(df_funds.index.values.astype('datetime64[ns]')),
+            'returns': pa.FixedSizeListArray.from_arrays(pa.array(returns.ravel()), returns.shape[1]),
+        },
+        metadata={'fdp_return_panels': json.dumps(metadata)}
+    )
+
+    # write to a temporary file and move it in place, readers may have the current file mapped
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    os.close(fd)
+
+    try:
+        if path.endswith('.parquet'):
+            pq.write_table(table, temp_path)
+        else:
+            with pa.OSFile(temp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table, max_chunksize=max(len(table), 1))
+
+        os.replace(temp_path, path)
+
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    return metadata
+
+
+def load_return_panels(path):
+    """
+    Function to load the fund and factor returns saved by save_return_panels.
+    An Arrow IPC file is memory-mapped and the returns are views of the mapping, read-only and shared with every
+    other process loading the same file.
+    :param path: string.
+    :return: tuple(pd.DataFrame, pd.DataFrame, dict). Fund returns, factor returns and the metadata.
+    """
+
+    if path.endswith('.parquet'):
+        table = pq.read_table(path, memory_map=True)
+    else:
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+
+    metadata = json.loads(table.schema.metadata[b'fdp_return_panels'])
+    columns = metadata['tickers'] + metadata['factor_names']
+
+    # combine_chunks copies even a single chunk, the IPC file is written as one
+    dates, returns = [
+        column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+        for column in (table.column('date'), table.column('returns'))
+    ]
+
+    values = returns.values.to_numpy(zero_copy_only=not path.endswith('.parquet')).reshape(len(returns), len(columns))
+    index = pd.DatetimeIndex(dates.to_numpy(zero_copy_only=False), name='date')
+
+    df_returns = pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+    return (*split_return_panel(df_returns, len(metadata['tickers'])), metadata)
+
+
+def get_factor_moments(X):
+    """
+    Function to compute the correlation matrix of the factors and their means over their standard deviations.
+    Only the dates where every factor has a return are used, e.g. from the inception of the youngest factor.
+    :param X: pd.DataFrame. Factor returns, NaN where missing.
+    :return: tuple(np.ndarray, np.ndarray)
+    """
+
+    values = np.asarray(X, dtype=np.float64)
+    values = values[~np.isnan(values).any(axis=1)]
+
+    if len(values) < 2:
+        raise ValueError('The factors need returns on at least 2 common dates to compute their VIFs')
+    corr = np.corrcoef(values, rowvar=False).reshape(values.shape[1], values.shape[1])
+    z = values.mean(axis=0) / values.std(axis=0)
+
+    return corr, z
+
+
+def invert_correlation(corr, max_condition=1e10):
+    """
+    Function to invert a factor correlation matrix, with the pseudo-inverse when it is close to singular.
+    """
+
+    if len(corr) and np.linalg.cond(corr) > max_condition:
+        print('The factors are almost collinear, the VIFs are based on the pseudo-inverse of their correlations')
+        return np.linalg.pinv(corr, hermitian=True)
+
+    return np.linalg.inv(corr)
+
+
+def vif_frame(names, inverse, z):
+    """
+    Function to build the VIF table of regression_vif from an inverse correlation matrix.
+    The VIF of a factor is the diagonal of the inverse correlation matrix, and the VIF of the constant is
+    1 + z' R^-1 z, with z the means of the factors over their standard deviations.
+    """
+
+    vif = pd.DataFrame()
+    vif['variables'] = ['const'] + list(names)
+    vif['VIF'] = np.concatenate([[1 + z @ inverse @ z], np.diag(inverse)])
+
+    return vif
+
+
+def regression_vif(X):
+    # values above 5 indicate high correlation between factors
+    # Calculating VIF from one inversion of the factor correlation matrix, instead of one regression per factor
+    corr, z = get_factor_moments(X)
+
+    return vif_frame(X.columns, invert_correlation(corr), z)
+
+
+class VIFCache:
+    """
+    VIFs of a changing selection of factors, e.g. the app's factor multiselect.
+    The correlations of every factor are computed once, and the inverse correlation matrix of the selection is
+    updated one factor at a time when factors are added (bordered inverse) or removed (Schur complement),
+    instead of being recalculated. It is recalculated when an update is numerically unreliable.
+    """
+
+    def __init__(self):
+        self.df_factors = None
+        self.corr = None
+        self.z = None
+        self.selected = []
+        self.inverse = np.empty((0, 0))
+        self.lock = threading.Lock()
+
+    def reset(self, df_factors):
+        """
+        Start over with a new panel of factor returns.
+        """
+
+        self.df_factors = df_factors
+        self.corr, self.z = get_factor_moments(df_factors)
+        self.selected = []
+        self.inverse = np.empty((0, 0))
+
+    def remove(self, position):
+        """
+        Remove a factor from the inverse correlation matrix of the selection.
+        """
+
+        j = self.selected.index(position)
+        keep = [i for i in range(len(self.selected)) if i != j]
+        P = self.inverse
+
+        self.inverse = P[np.ix_(keep, keep)] - np.outer(P[keep, j], P[j, keep]) / P[j, j]
+        self.selected.pop(j)
+
+    def add(self, position):
+        """
+        Add a factor to the inverse correlation matrix of the selection, return False if it is collinear.
+        """
+
+        b = self.corr[self.selected, position]
+        u = self.inverse @ b
+        s = 1 - b @ u
+
+        if s < 1e-10:
+            return False
+
+        n = len(self.selected)
+        inverse = np.empty((n + 1, n + 1))
+        inverse[:n, :n] = self.inverse + np.outer(u, u) / s
+        inverse[:n, n] = inverse[n, :n] = -u / s
+        inverse[n, n] = 1 / s
+
+        self.inverse = inverse
+        self.selected.append(position)
+
+        return True
+
+    def get_vif(self, df_factors, factors):
+        """
+        Return the VIF table of regression_vif for the ``factors`` columns of df_factors.
+        :param df_factors: pd.DataFrame. Returns of every factor that can be selected.
+        :param factors: list[strings]. Selected factor names, columns of df_factors.
+        :return: pd.DataFrame
+        """
+
+        with self.lock:
+            same_panel = (
+                self.df_factors is not None and self.df_factors.columns.equals(df_factors.columns)
+                and self.df_factors.index.equals(df_factors.index)
+                and np.array_equal(self.df_factors.to_numpy(), df_factors.to_numpy(), equal_nan=True)
+            )
+
+            if not same_panel:
+                self.reset(df_factors)
+
+            positions = [df_factors.columns.get_loc(factor) for factor in factors]
+
+            for position in [position for position in self.selected if position not in positions]:
+                self.remove(position)
+
+            for position in [position for position in positions if position not in self.selected]:
+                if not self.add(position):
+                    # collinear with the selection, the pseudo-inverse cannot be updated, start over next time
+                    inverse = invert_correlation(self.corr[np.ix_(positions, positions)])
+                    self.selected = []
+                    self.inverse = np.empty((0, 0))
+
+                    return vif_frame(factors, inverse, self.z[positions])
+
+            # VIFs are at least 1, anything else is accumulated rounding error
+            if len(self.selected) and np.diag(self.inverse).min() < 1 - 1e-8:
+                self.inverse = invert_correlation(self.corr[np.ix_(self.selected, self.selected)])
+
+            order = [self.selected.index(position) for position in positions]
+
+            return vif_frame(factors, self.inverse[np.ix_(order, order)], self.z[positions])
+
+
+class BatchOLSResults:
+    """
+    Results of the OLS regressions of a batch of funds on the same factors, see batch_ols.
+    Every statistic is one array row or element per fund, shared by the whole batch, instead of one statsmodels
+    results object per fund holding copies of the data. Indexing by fund position or name returns an OLSResult.
+    """
+
+    __slots__ = ('params', 'bse', 'scale', 'rsquared', 'nobs', 'df_resid', 'exog_names', 'endog_names', 'has_const',
+                 'cov_type')
+
+    def __init__(self, params, bse, scale, rsquared, nobs, df_resid, exog_names, endog_names, has_const=True,
+                 cov_type='nonrobust'):
+        self.params = params
+        self.bse = bse
+        self.scale = scale
+        self.rsquared = rsquared
+        self.nobs = nobs
+        self.df_resid = df_resid
+        self.exog_names = exog_names
+        self.endog_names = endog_names
+        self.has_const = has_const
+        self.cov_type = cov_type
+
+    def __len__(self):
+        return self.params.shape[1]
+
+    def __getitem__(self, fund):
+        column = fund if isinstance(fund, (int, np.integer)) else self.endog_names.index(fund)
+
+        if not -len(self) <= column < len(self):
+            raise IndexError(f'Fund {fund} is not in the batch of {len(self)} funds')
+
+        return OLSResult(self, column % len(self))
+
+    def __iter__(self):
+        return (OLSResult(self, column) for column in range(len(self)))
+
+    @property
+    def tvalues(self):
+        return self.params / self.bse
+
+    @property
+    def use_t(self):
+        # like statsmodels, robust covariances use the normal distribution
+        return self.cov_type == 'nonrobust'
+
+    @property
+    def distribution(self):
+        return stats.t(self.df_resid) if self.use_t else stats.norm()
+
+    @property
+    def pvalues(self):
+        return 2 * self.distribution.sf(np.abs(self.tvalues))
+
+    @property
+    def rsquared_adj(self):
+        return 1 - (1 - self.rsquared) * (self.nobs - self.has_const) / self.df_resid
+
+
+class OLSResult:
+    """
+    OLS regression of one fund of a BatchOLSResults, with the statsmodels results attributes used in this module.
+    Holds no data of its own, the statistics are read from the batch and the summary is only built when asked.
+    """
+
+    __slots__ = ('batch', 'column')
+
+    def __init__(self, batch, column):
+        self.batch = batch
+        self.column = column
+
+    def __repr__(self):
+        return f'OLSResult({self.name!r}, rsquared={self.rsquared:.4f}, nobs={self.nobs})'
+
+    @property
+    def name(self):
+        return self.batch.endog_names[self.column]
+
+    @property
+    def params(self):
+        return pd.Series(self.batch.params[:, self.column], index=self.batch.exog_names, name=self.name)
+
+    @property
+    def bse(self):
+        return pd.Series(self.batch.bse[:, self.column], index=self.batch.exog_names, name=self.name)
+
+    @property
+    def tvalues(self):
+        return self.params / self.bse
+
+    @property
+    def pvalues(self):
+        return pd.Series(2 * self.batch.distribution.sf(np.abs(self.tvalues)), index=self.batch.exog_names,
+                         name=self.name)
+
+    @property
+    def scale(self):
+        return self.batch.scale[self.column]
+
+    @property
+    def rsquared(self):
+        return self.batch.rsquared[self.column]
+
+    @property
+    def rsquared_adj(self):
+        return self.batch.rsquared_adj[self.column]
+
+    @property
+    def nobs(self):
+        return self.batch.nobs
+
+    @property
+    def df_resid(self):
+        return self.batch.df_resid
+
+    def conf_int(self, alpha=0.05):
+        """
+        Return the confidence intervals of the coefficients.
+        """
+
+        width = self.batch.distribution.ppf(1 - alpha / 2) * self.bse
+
+        return pd.DataFrame({0: self.params - width, 1: self.params + width})
+
+    def summary(self, alpha=0.05):
+        """
+        Build a statsmodels summary of the regression.
+        """
+
+        summary = Summary()
+        summary.add_table_2cols(
+            self,
+            gleft=[
+                ('Dep. Variable:', [self.name]),
+                ('Model:', ['OLS']),
+                ('Method:', ['Least Squares']),
+                ('No. Observations:', [self.nobs]),
+                ('Df Residuals:', [self.df_resid]),
+                ('Df Model:', [len(self.batch.exog_names) - self.batch.has_const]),
+                ('Covariance Type:', [self.batch.cov_type]),
+            ],
+            gright=[
+                ('R-squared:', [f'{self.rsquared:#8.3f}']),
+                ('Adj. R-squared:', [f'{self.rsquared_adj:#8.3f}']),
+                ('Scale:', [f'{self.scale:#8.3g}']),
+            ],
+            title='OLS Regression Results',
+            yname=self.name,
+            xname=self.batch.exog_names
+        )
+        summary.tables.append(summary_params(
+            (self, self.params.to_numpy(), self.bse.to_numpy(), self.tvalues.to_numpy(), self.pvalues.to_numpy(),
+             self.conf_int(alpha).to_numpy()),
+            yname=self.name, xname=self.batch.exog_names, alpha=alpha, use_t=self.batch.use_t
+        ))
+
+        return summary
+
+
+def linear_reg(y, x, add_const=False, cov_type='nonrobust', maxlags=None):
+    '''
+    Calculates simple and multiple regression model with batch_ols.
+    adds constant to dependent variables automatically.
+
+    Parameters
+    ----------
+    y : DataFrame
+        dependent variable
+    x : DataFrame
+        independent variables
+    cov_type : str
+        'nonrobust' or 'HAC' for Newey-West standard errors
+    maxlags : int
+        number of lags of the HAC covariance
+
+    Returns
+    -------
+    OLSResult, with the params, bse, tvalues, rsquared and summary() of a statsmodels regression object
+
+    Dates where y or a factor is missing are dropped, like statsmodels' missing='drop'.
+
+    '''
+    y = y if isinstance(y, pd.DataFrame) else pd.DataFrame(y)
+
+    valid = ~np.isnan(np.asarray(y, dtype=np.float64)).any(axis=1)
+    valid &= ~np.isnan(np.asarray(x, dtype=np.float64).reshape(len(valid), -1)).any(axis=1)
+
+    if not valid.all():
+        y, x = y[valid], x[valid]
+
+    lm = batch_ols(y, x, add_const=True, cov_type=cov_type, maxlags=maxlags)[0]
+
+    return lm
+
+
+def hac_meat(X, U, maxlags):
+    """
+    Function to compute the Newey-West sum of lagged score cross-products of every fund at once.
+    For each lag l the products of the residuals u_t u_t-l of all the funds are contracted with the factor
+    products x_t x_t-l' in one matrix product, and weighted with the Bartlett kernel 1 - l / (maxlags + 1).
+    :param X: np.ndarray. (date x coefficient) design matrix.
+    :param U: np.ndarray. (date x fund) residuals.
+    :param maxlags: int.
+    :return: np.ndarray. (fund x coefficient x coefficient) matrices.
+    """
+
+    n_params = X.shape[1]
+    meat = (np.square(U).T @ np.einsum('ti,tj->tij', X, X).reshape(len(X), -1)).reshape(-1, n_params, n_params)
+
+    for lag in range(1, maxlags + 1):
+        products = np.einsum('ti,tj->tij', X[lag:], X[:-lag]).reshape(len(X) - lag, -1)
+        lagged = ((U[lag:] * U[:-lag]).T @ products).reshape(-1, n_params, n_params)
+        meat += (1 - lag / (maxlags + 1)) * (lagged + lagged.transpose(0, 2, 1))
+
+    return meat
+
+
+def batch_ols(returns, factor_returns, add_const=True, block_size=4096, cov_type='nonrobust', maxlags=None):
+    """
+    Function to fit the OLS regression of every fund on the same factors at once.
+    The factor matrix is factorized once, X = QR, and the coefficients of all the funds are solved from Q'Y,
+    computed in float64 over blocks of ``block_size`` funds so that float32 returns are never converted as a whole.
+    Matches the params, bse, tvalues and rsquared of statsmodels' OLS fitted fund by fund.
+    :param returns: pd.DataFrame or np.ndarray. Fund returns, one column per fund, without missing values.
+        Returns with missing values raise a ValueError, they are regressed by masked_ols_params.
+    :param factor_returns: pd.DataFrame or np.ndarray. Factor returns on the same dates, without missing values.
+    :param add_const: bool. Add an intercept as the first coefficient. R-squared is centered with an intercept.
+    :param block_size: int. Number of funds processed at a time.
+    :param cov_type: string. 'nonrobust' for the classical standard errors, or 'HAC' for the heteroskedasticity and
+        autocorrelation robust standard errors of Newey-West, like statsmodels' fit(cov_type='HAC').
+    :param maxlags: int. Number of lags of the HAC covariance, defaults to floor(4 (nobs / 100) ^ (2 / 9)).
+    :return: BatchOLSResults. params, bse and tvalues with one column per fund, rsquared and scale, the residual
+        variance, per fund, and nobs and df_resid.
+    """
+
+    Y = np.asarray(returns)
+    X = np.asarray(factor_returns, dtype=np.float64)
+
+    if add_const:
+        X = np.column_stack([np.ones(len(X)), X])
+
+    if cov_type not in ('nonrobust', 'HAC'):
+        raise ValueError(f'Unsupported cov_type {cov_type}, use nonrobust or HAC')
+
+    if np.isnan(X).any():
+        raise ValueError('The factor returns have missing values, drop the incomplete dates or use masked_ols_params')
+
+    n_obs, n_params = X.shape
+    Q, R = np.linalg.qr(X)
+    R_inv = np.linalg.inv(R)
+
+    # (X'X)^-1 = R^-1 R^-T
+    XtX_inv = R_inv @ R_inv.T
+
+    if maxlags is None:
+        maxlags = int(np.floor(4 * (n_obs / 100) ** (2 / 9)))
+
+    params = np.empty((n_params, Y.shape[1]))
+    bse = np.empty((n_params, Y.shape[1]))
+    ssr = np.empty(Y.shape[1])
+    tss = np.empty(Y.shape[1])
+
+    for start in range(0, Y.shape[1], block_size):
+        block = slice(start, start + block_size)
+        Y_block = Y[:, block].astype(np.float64, copy=False)
+
+        if np.isnan(Y_block).any():
+            raise ValueError('The fund returns have missing values, drop the incomplete dates or use masked_ols_params')
+
+        params[:, block] = R_inv @ (Q.T @ Y_block)
+        residuals = Y_block - X @ params[:, block]
+        ssr[block] = np.square(residuals).sum(axis=0)
+        tss[block] = np.square(Y_block - Y_block.mean(axis=0) if add_const else Y_block).sum(axis=0)
+
+        if cov_type == 'HAC':
+            # sandwich (X'X)^-1 S (X'X)^-1 of every fund, only its diagonal is kept
+            cov = np.einsum('ij,fjk,ik->fi', XtX_inv, hac_meat(X, residuals, maxlags), XtX_inv)
+            bse[:, block] = np.sqrt(cov).T
+
+    df_resid = n_obs - n_params
+    scale = ssr / df_resid
+
+    if cov_type == 'nonrobust':
+        bse = np.sqrt(np.diag(XtX_inv)[:, np.newaxis] * scale)
+
+    # name the coefficients and funds like statsmodels
+    if hasattr(factor_returns, 'columns'):
+        exog_names = [str(name) for name in factor_returns.columns]
+    else:
+        exog_names = [f'x{i}' for i in range(1, X.shape[1] + 1 - add_const)]
+
+    endog_names = list(getattr(returns, 'columns', range(Y.shape[1])))
+
+    return BatchOLSResults(params, bse, scale, 1 - ssr / tss, n_obs, df_resid,
+                           ['const'] * add_const + exog_names, endog_names, add_const, cov_type)
+
+
+def get_mask_patterns(valid):
+    """
+    Function to group the columns of a validity mask by their pattern of valid rows.
+    The columns are packed into bitmaps, one bit per row, before being compared.
+    :param valid: np.ndarray. Boolean (row x column) mask.
+    :return: tuple(np.ndarray, np.ndarray). The index of the first column of every pattern, and the pattern of
+        every column.
+    """
+
+    bitmaps = np.ascontiguousarray(np.packbits(valid, axis=0).T)
+    _, first, inverse = np.unique(bitmaps.view(np.dtype((np.void, bitmaps.shape[1]))).ravel(),
+                                  return_index=True, return_inverse=True)
+
+    return first, inverse
+
+
+def masked_ols_params(returns, factor_returns, add_const=False, min_obs=None, omit_factors=False):
+    """
+    Function to compute the OLS coefficients of every fund on its own valid window, instead of on the dates
+    where every fund has a return. A date is used for a fund when the fund and every factor have a return,
+    so a factor younger than the fund, e.g. QUAL or IMTM, still shortens the window to its own inception.
+    With ``omit_factors`` every date where the fund has a return is used instead, and the factors missing on
+    any of these dates are left out of that fund's regression.
+    Funds with the same valid dates, e.g. the same inception, are solved together in one least squares call.
+    :param returns: pd.DataFrame or np.ndarray. Fund returns, NaN where missing.
+    :param factor_returns: pd.DataFrame or np.ndarray. Factor returns on the same dates, NaN where missing.
+    :param add_const: bool. Add an intercept as the first coefficient.
+    :param min_obs: int. Minimum number of dates to estimate a fund, defaults to the number of coefficients + 1.
+        The coefficients of the funds below it are NaN.
+    :param omit_factors: bool. Fit each fund on the factors available over its whole history, the coefficients
+        of the factors left out are NaN.
+    :return: tuple(np.ndarray, np.ndarray). float64 coefficients, one column per fund, and the number of dates
+        used for each fund.
+    """
+
+    Y = np.asarray(returns)
+    X = np.asarray(factor_returns, dtype=np.float64)
+
+    if add_const:
+        X = np.column_stack([np.ones(len(X)), X])
+
+    factor_valid = ~np.isnan(X)
+    valid = ~np.isnan(Y)
+
+    if not omit_factors:
+        valid &= factor_valid.all(axis=1)[:, np.newaxis]
+
+    n_obs = valid.sum(axis=0)
+    params = np.full((X.shape[1], Y.shape[1]), np.nan)
+
+    first, inverse = get_mask_patterns(valid)
+    groups = np.split(np.argsort(inverse, kind='stable'), np.cumsum(np.bincount(inverse))[:-1])
+
+    for column, columns in zip(first, groups):
+        rows = valid[:, column]
+        factors = factor_valid[rows].all(axis=0)
+
+        if not factors.any() or n_obs[column] < (factors.sum() + 1 if min_obs is None else min_obs):
+            continue
+
+        params[np.ix_(factors, columns)] = np.linalg.lstsq(
+            X[np.ix_(rows, factors)], Y[np.ix_(rows, columns)].astype(np.float64), rcond=None
+        )[0]
+
+    return params, n_obs
+
+
+def rolling_ols(returns, factor_returns, window=36, step=1, min_obs=None, add_const=True):
+    """
+    Function to fit the OLS regression of every fund on the factors over rolling windows, to follow style drift.
+    The sums X'X and X'Y of the window are kept up to date by adding the rows entering the window and removing
+    the rows leaving it at each step, instead of refitting every window from scratch, and are recalculated once
+    per window length to keep rounding errors from accumulating.
+    Missing fund returns are skipped: each fund then has its own X'X, updated for all the funds in one matrix product.
+    :param returns: pd.DataFrame or np.ndarray. Fund returns, one column per fund, NaN where missing.
+    :param factor_returns: pd.DataFrame or np.ndarray. Factor returns on the same dates.
+    :param window: int. Number of dates of each window.
+    :param step: int. Number of dates between the ends of two windows.
+    :param min_obs: int. Minimum number of dates to estimate a fund in a window, defaults to the number of
+        coefficients + 1. The coefficients of the funds below it are NaN.
+    :param add_const: bool. Add an intercept as the first coefficient.
+    :return: tuple(pd.Index, np.ndarray). The last date of every window, and the (date x fund x coefficient)
+        float64 coefficients.
+    """
+
+    Y = np.asarray(returns)
+    X = np.asarray(factor_returns, dtype=np.float64)
+
+    if add_const:
+        X = np.column_stack([np.ones(len(X)), X])
+
+    n_dates, n_params = X.shape
+    n_funds = Y.shape[1]
+
+    if min_obs is None:
+        min_obs = n_params + 1
+
+    # dates without every factor are skipped for all the funds
+    valid_dates = ~np.isnan(X).any(axis=1)
+    X = np.where(valid_dates[:, np.newaxis], X, 0)
+    masked = bool(np.isnan(Y).any()) or not valid_dates.all()
+
+    # x_t x_t' of every date, flattened, so that the X'X of all the funds is one product with their masks
+    XX = np.einsum('ti,tj->tij', X, X).reshape(n_dates, -1)
+
+    def window_sums(rows):
+        Y_rows = Y[rows].astype(np.float64)
+        valid = ~np.isnan(Y_rows) & valid_dates[rows, np.newaxis]
+        Y_rows[~valid] = 0
+
+        XtX = valid.T.astype(np.float64) @ XX[rows] if masked else XX[rows].sum(axis=0)
+
+        return XtX, X[rows].T @ Y_rows, valid.sum(axis=0)
+
+    ends = np.arange(window - 1, n_dates, step)
+    params = np.full((len(ends), n_funds, n_params), np.nan)
+    refresh = max(window // step, 1)
+
+    for i, end in enumerate(ends):
+        if i % refresh == 0 or step >= window:
+            XtX, XtY, n_obs = window_sums(slice(end - window + 1, end + 1))
+        else:
+            previous = ends[i - 1]
+            XtX_in, XtY_in, n_in = window_sums(slice(previous + 1, end + 1))
+            XtX_out, XtY_out, n_out = window_sums(slice(previous - window + 1, end - window + 1))
+
+            XtX += XtX_in - XtX_out
+            XtY += XtY_in - XtY_out
+            n_obs += n_in - n_out
+
+        estimated = n_obs >= min_obs
+
+        if not estimated.any():
+            continue
+
+        if masked:
+            A = XtX.reshape(n_funds, n_params, n_params)[estimated]
+            b = XtY.T[estimated][..., np.newaxis]
+
+            try:
+                params[i, estimated] = np.linalg.solve(A, b)[..., 0]
+            except np.linalg.LinAlgError:
+                params[i, estimated] = (np.linalg.pinv(A, hermitian=True) @ b)[..., 0]
+
+        else:
+            params[i] = np.linalg.lstsq(XtX.reshape(n_params, n_params), XtY, rcond=None)[0].T
+
+    dates = getattr(returns, 'index', pd.RangeIndex(n_dates))[ends]
+
+    return dates, params
+
+
+def multiple_lin_reg(returns, factor_returns, add_const=False, omit_factors=False):
+    """
+    Function to compute regular OLS regression on a group of supplied returns
+    :param tickers:
+    :param factors:
+    :param add_const:
+    :param omit_factors: bool. With missing returns, fit each fund on its whole history and leave out the factors
+        missing on it, see masked_ols_params.
+    :return:
+    """
+
+    # fit every fund at once, with the constant as linear_reg does
+    if returns.isna().any(axis=None) or factor_returns.isna().any(axis=None):
+        # returns kept with dropna=False, each fund is fitted on the dates where it and every factor have a return
+        params = masked_ols_params(returns, factor_returns, add_const=True, omit_factors=omit_factors)[0]
+    else:
+        params = batch_ols(returns, factor_returns, add_const=True).params
 
-    # drop the constant, rename columns and index
-    df_results.drop('const', axis=0, inplace=True)
-    df_results.index = factor_returns.columns
-    df_results.columns = returns.columns
+    # drop the constant, name the columns and index
+    df_results = pd.DataFrame(params[1:], index=factor_returns.columns, columns=returns.columns)
     print('Regression analysis completed')
 
     return df_results
@@ -269,24 +2552,29 @@ def lasso_lars_regression(returns, factor_returns):
 
 
 # %% execute
+if __name__ == '__main__':
+    # test = get_stock_prices(tickers[2], start_date, end_date)
 
-# test = get_stock_prices(tickers[2], start_date, end_date)
+    # retrieve the fund and factor returns in one pass over the data provider
+    df_funds, df_factors = run_sync(async_get_all_returns(tickers, factors_dict, start_date, end_date))
 
-df_funds = get_returns(tickers, start_date, end_date)
-df_factors = retrieve_factor_returns(factors_dict, start_date, end_date)
+    # share the aligned returns with other jobs and the app
+    if return_panel_path:
+        save_return_panels(return_panel_path, df_funds, df_factors, 'M', factors_dict, start_date=start_date,
+                           end_date=end_date, excess=False, log=False)
 
-# truncate the fund returns df to match the available factor data
-df_funds = df_funds.loc[df_factors.index[0]:]
+    # test the VIF
+    regression_vif(df_factors)
 
-# test the VIF
-regression_vif(df_factors)
+    # test a non-regularized regression
+    lin_reg = linear_reg(df_funds.iloc[:, 3], df_factors, True)
+    lin_reg.summary()
 
-# test a non-regularized regression
-lin_reg = linear_reg(df_funds.iloc[:, 3], df_factors, True)
-lin_reg.summary()
+    simple_lr_results = multiple_lin_reg(df_funds, df_factors, True)
 
-simple_lr_results = multiple_lin_reg(df_funds, df_factors, True)
+    # follow the style drift with 36 month rolling regressions
+    rolling_dates, rolling_exposures = rolling_ols(df_funds, df_factors, window=36)
 
-# run the regression
-results = lasso_lars_regression(df_funds, df_factors)
+    # run the regression
+    results = lasso_lars_regression(df_funds, df_factors)
 
@@ -7,28 +7,24 @@ Created by Cordell L. Tanny, CFA, FRM, FDP
 February 2023
 '''
 
-import json
 import os
-import ssl
 import warnings
-from urllib.request import urlopen
-import pandas as pd
 import plotly.express as px
 import streamlit as st
-from sklearn.linear_model import LassoLars
-from sklearn.linear_model import LassoLarsIC
-from sklearn.pipeline import make_pipeline
-from sklearn.preprocessing import StandardScaler
-from statsmodels.regression.linear_model import OLS
-from statsmodels.stats.outliers_influence import variance_inflation_factor
-from statsmodels.tools.tools import add_constant
+import factor_analysis
+from factor_analysis import FetchClient
+from factor_analysis import VIFCache
+from factor_analysis import async_get_all_returns
+from factor_analysis import factors_dict
+from factor_analysis import lasso_lars_regression
+from factor_analysis import load_return_panels
+from factor_analysis import return_panel_path
+from factor_analysis import run_sync
+from factor_analysis import tickers
 
 # prevent FutureWarnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
-# context for certificates needed in urllib/requests
-ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-
 
 # remove plotly menu bar
 config = {'displayModeBar': False}
@@ -37,236 +33,16 @@ config = {'displayModeBar': False}
 start_date = '2012-01-01'
 end_date = '2023-01-31'
 
-eod_api_key = os.environ['EOD_API_KEY']
-
-tickers = [
-    'QIACX',
-    'VTSAX',
-    'FCNTX',
-    'TRBCX',
-]
-
-factors_dict = {
-    'US Growth': 'VUG',
-    'US Value': 'VTV',
-    # 'US Momentum': 'MTUM',
-    'US Dividend': 'SCHD',
-    'US Quality': 'QUAL',
-    'US Defensive': 'DEF',
-    'US Small Cap': 'VB',
-    'US Mid Cap': 'VO',
-    'US Large Cap': 'VV',
-    # 'US Credit': 'LQD',
-    # 'US High Yield': 'JNK',
-    # 'US Government': 'GOVT',
-    'Intl Growth': 'EFG',
-    'Intl Value': 'EFV',
-    'Intl Momentum': 'IMTM',
-    'Intl Dividend': 'IDV',
-    'Intl Quality': 'IQLT',
-    'Intl Small-Cap': 'GWX',
-    # 'Intl Credit': 'IBND',
-    # 'Intl High Yield': 'IHY',
-    # 'Intl Government': 'IGOV',
-}
 
 # %% functions
-def get_stock_prices(symbol, start_date, end_date):
-    """
-    Receive the content of ``url``, parse it as JSON and return the object.
-    """
-
-    if '.TO' not in symbol:
-        ticker = symbol + '.US'
-    else:
-        ticker = symbol
-
-    url = f'https://eodhistoricaldata.com/api/eod/{ticker}?from={start_date}&to={end_date}&' \
-          f'period=d&api_token={eod_api_key}&fmt=json'
-
-    response = urlopen(url, context=ssl_context)
-    data = response.read().decode("utf-8")
-
-    prices = json.loads(data)
-
-    prices = pd.DataFrame(prices).set_index('date').sort_index()
-
-    return prices
-
-
-def get_returns(tickers: list, start_date, end_date, frequency='M'):
-    """
-    Function to retrieve daily prices from yahoo finance
-    :param tickers: list[strings]. Yahoo finance tickers supplied as a list.
-    :param start_date: string.
-    :param end_date: string.
-    :param frequency: string. 'D' for daily, 'M' for monthly. Default is monthly.
-    :return: pd.DataFrame
-    """
-
-    df_prices = pd.DataFrame()
-
-    for ticker in tickers:
-        df_temp = get_stock_prices(ticker, start_date, end_date)[['adjusted_close']]
-
-        # convert the index to datetime
-        df_temp.index = pd.to_datetime(df_temp.index)
-
-        # add the prices to df_prices
-        df_prices = pd.concat([df_prices, df_temp], axis=1)
-
-    # calculate the percent change based on the desired frequency
-    match frequency:
-        case 'D':
-            df_returns = df_prices.pct_change().dropna()
-
-        case 'M':
-            df_returns = df_prices.resample('M').last().pct_change().dropna()
-
-    # rename the columns
-    df_returns.columns = tickers
-
-    print('All tickers successfully retrieved')
-
-    return df_returns
-
-
-def retrieve_factor_returns(factors: dict, start_date: str, end_date: str, frequency='M'):
-    """
-    Function to retrieve factor prices from yahoo finance and return a dataframe of factor returns
-    :param factors:
-    :param start_date:
-    :param end_date:
-    :param frequency:
-    :return:
-    """
-
-    df_prices = pd.DataFrame()
-
-    for factor in list(factors.values()):
-        df_temp = get_stock_prices(factor, start_date, end_date)[['adjusted_close']]
-
-        # convert the index to datetime
-        df_temp.index = pd.to_datetime(df_temp.index)
-
-        # add the prices to df_prices
-        df_prices = pd.concat([df_prices, df_temp], axis=1)
-
-    # calculate the percent change based on the desired frequency
-    match frequency:
-        case 'D':
-            df_returns = df_prices.pct_change().dropna()
-
-        case 'M':
-            df_returns = df_prices.resample('M').last().pct_change().dropna()
-
-    # rename the columns
-    df_returns.columns = list(factors.keys())
-
-    print(f'All factors successfully retrieved')
-
-    return df_returns
-
-
-def regression_vif(X):
-    # values above 5 indicate high correlation between factors
-    # Calculating VIF
-    X = add_constant(X)
-    vif = pd.DataFrame()
-    vif['variables'] = X.columns
-    vif['VIF'] = [variance_inflation_factor(X.values, i) for i in range(X.shape[1])]
-
-    return vif
-
-
-def linear_reg(y, x, add_const=False):
-    '''
-    Calculates simple and multiple regression model using statsmodels.
-    adds constant to dependent variables automatically.
-
-    Parameters
-    ----------
-    y : DataFrame
-        dependent variable
-    x : DataFrame
-        independent variables
-
-    Returns
-    -------
-    statsmodels regression object
-
-    '''
-    if add_const:
-        x = x.copy()
-
-    x = add_constant(x.values)
-
-    lm = OLS(y, x).fit()
-
-    return lm
-
-
-def multiple_lin_reg(returns, factor_returns, add_const=False):
+@st.cache_resource
+def get_fetch_client():
     """
-    Function to compute regular OLS regression on a group of supplied returns
-    :param tickers:
-    :param factors:
-    :param add_const:
-    :return:
+    Return the FetchClient shared by every session of the app.
+    Cached by streamlit so that the connection pool survives reruns of the script.
     """
 
-    df_results = pd.DataFrame()
-
-    for ticker in returns:
-        lin_reg = linear_reg(returns[ticker], factor_returns, True)
-        df_results = pd.concat([df_results, lin_reg.params], axis=1)
-
-    # drop the constant, rename columns and index
-    df_results.drop('const', axis=0, inplace=True)
-    df_results.index = factor_returns.columns
-    df_results.columns = returns.columns
-    print('Regression analysis completed')
-
-    return df_results
-
-
-def lasso_lars_regression(returns, factor_returns):
-    """
-    Function to calculate the regression coefficient based on LASSO
-    :param tickers:
-    :param factors:
-    :return:
-    """
-
-    # initialize an empty dataframe to store the results
-    df_results = pd.DataFrame()
-
-    for ticker in returns:
-        y = returns[ticker]
-        X = factor_returns.copy()
-
-        # run the lasso regression
-        lasso_lars_ic = make_pipeline(
-            StandardScaler(), LassoLarsIC(criterion="aic", normalize=False)
-        ).fit(X, y)
-
-        # select the alpha
-        alpha_aic = lasso_lars_ic[-1].alpha_
-
-        # rerun with that alpha
-        best_alpha_lasso = LassoLars(alpha=alpha_aic, normalize=True)
-        best_alpha_lasso.fit(X, y)
-        # print(best_alpha_lasso.coef_)
-
-        # create a df with the results
-        df_temp = pd.DataFrame(data=best_alpha_lasso.coef_, index=factor_returns.columns,
-                               columns=[ticker])
-
-        df_results = pd.concat([df_results, df_temp], axis=1)
-
-    print('Lasso regression completed')
-
-    return df_results
+    return FetchClient()
 
 
 def feature_barplot(regression_results):
@@ -304,6 +80,9 @@ def feature_barplot(regression_results):
 
 st.header('Style and Factor Analysis Modeling')
 
+# the engine fetches through the client cached by streamlit, see get_fetch_client
+factor_analysis.fetch_client = get_fetch_client()
+
 # component 1: Add multi-select box to chose investment options
 funds = st.multiselect(
     label='Select Investments:',
@@ -318,6 +97,26 @@ factors = st.multiselect(
     key='select_factors'
 )
 
+frequency_labels = {'Daily': 'D', 'Weekly': 'W', 'Monthly': 'M', 'Quarterly': 'Q'}
+
+# the returns of every frequency are derived from one cached daily price panel, switching is immediate
+frequency = st.selectbox(
+    label='Return Frequency:',
+    options=list(frequency_labels.keys()),
+    index=2,
+    key='select_frequency'
+)
+
+return_types = {'Simple': (False, False), 'Excess': (True, False), 'Log': (False, True), 'Log Excess': (True, True)}
+
+# excess returns are over the T-bill returns of risk_free_symbol
+return_type = st.selectbox(
+    label='Return Type:',
+    options=list(return_types.keys()),
+    index=0,
+    key='select_return_type'
+)
+
 init_btn = st.button(
     label='Run Analysis',
     key='init_btn'
@@ -325,12 +124,24 @@ init_btn = st.button(
 
 if init_btn:
     with st.spinner('Calculating...'):
-        # retrieve returns
-        df_funds = get_returns(tickers, start_date, end_date)
-        df_factors = retrieve_factor_returns(factors_dict, start_date, end_date)
+        # retrieve the fund and factor returns in one pass over the data provider
+        excess, log = return_types[return_type]
+        saved = None
+
+        if return_panel_path and os.path.exists(return_panel_path):
+            saved = load_return_panels(return_panel_path)
 
-        # truncate the fund returns df to match the available factor data
-        df_funds = df_funds.loc[df_factors.index[0]:]
+        request = {'frequency': frequency_labels[frequency], 'tickers': tickers, 'factors': factors_dict,
+                   'start_date': start_date, 'end_date': end_date, 'excess': excess, 'log': log}
+
+        if saved and all(saved[2].get(key) == value for key, value in request.items()):
+            # use the returns saved by the batch job
+            df_funds, df_factors, _ = saved
+        else:
+            df_funds, df_factors = run_sync(
+                async_get_all_returns(tickers, factors_dict, start_date, end_date, frequency_labels[frequency],
+                                      excess=excess, log=log)
+            )
 
         # test the VIF
         # regression_vif(df_factors)
@@ -341,6 +152,9 @@ if init_btn:
         #
         # simple_lr_results = multiple_lin_reg(df_funds, df_factors, True)
 
+        # keep the factor returns for the VIFs of the factor selection
+        st.session_state['df_factors'] = df_factors
+
         # run the regression
         results = lasso_lars_regression(df_funds, df_factors)
 
@@ -353,3 +167,12 @@ if init_btn:
         # graph the factor exposure bar chart
         fig = feature_barplot(results_filtered)
         st.plotly_chart(fig, use_container_width=True, config=config)
+
+# the VIFs follow the factor selection, updated one factor at a time by the session's VIFCache
+if 'df_factors' in st.session_state and factors:
+    vif_cache = st.session_state.setdefault('vif_cache', VIFCache())
+
+    cont_2 = st.container()
+    with cont_2:
+        st.markdown('#### Factor Variance Inflation')
+        st.dataframe(vif_cache.get_vif(st.session_state['df_factors'], factors))
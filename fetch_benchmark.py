@@ -0,0 +1,111 @@
+'''
+fetch_benchmark.py
+Load benchmark of the price retrieval layer of factor_analysis.py against the local EOD stand-in server.
+Measures symbols per second and the p50/p99 request latency at several concurrency levels, with the
+rate limiter, retries, connection pooling and parsing in the loop but without the local price store.
+Run with: python fetch_benchmark.py --symbols 500 --concurrency 1 4 16 64 --latency 0.05 --error-rate 0.01
+'''
+
+import argparse
+import asyncio
+import time
+import numpy as np
+import factor_analysis as fa
+from eod_stub_server import start_stub_server
+
+
+# %% functions
+async def timed_fetch(provider, symbol, start_date, end_date, semaphore, report, latencies):
+    """
+    Coroutine retrieving one symbol and recording its latency, excluding the time spent waiting for a worker.
+    """
+
+    async with semaphore:
+        start = time.perf_counter()
+        await provider.fetch(symbol, start_date, end_date, fa.price_fields, None, report)
+        latencies.append(time.perf_counter() - start)
+
+
+async def run_level(provider, symbols, start_date, end_date, concurrency):
+    """
+    Coroutine retrieving every symbol with ``concurrency`` requests in flight.
+    :return: dict. Throughput, latency percentiles, retries and errors of the run.
+    """
+
+    semaphore = asyncio.Semaphore(concurrency)
+    report = fa.new_fetch_report()
+    latencies = []
+
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *[timed_fetch(provider, symbol, start_date, end_date, semaphore, report, latencies) for symbol in symbols],
+        return_exceptions=True
+    )
+    elapsed = time.perf_counter() - start
+
+    return {
+        'concurrency': concurrency,
+        'symbols/s': len(symbols) / elapsed,
+        'p50 ms': np.percentile(latencies, 50) * 1000 if latencies else np.nan,
+        'p99 ms': np.percentile(latencies, 99) * 1000 if latencies else np.nan,
+        'throttled': sum(report['throttled'].values()),
+        'retried': sum(report['retried'].values()),
+        'errors': sum(isinstance(result, Exception) for result in results),
+    }
+
+
+def run_benchmark(url, n_symbols, concurrency_levels, start_date, end_date, requests_per_minute):
+    """
+    Function to run the benchmark at every concurrency level.
+    A new FetchClient is created for each level, so that no level reuses the connections or the rate limiter
+    of the previous one.
+    :return: list[dict]. One row of results per concurrency level.
+    """
+
+    # measure the network path, not the local price store
+    fa.price_cache_dir = None
+
+    symbols = [f'SYM{i:05d}' for i in range(n_symbols)]
+    rows = []
+
+    for concurrency in concurrency_levels:
+        client = fa.FetchClient(requests_per_minute=requests_per_minute)
+        fa.fetch_client = client
+        # the stand-in server ignores the API key
+        provider = fa.EODProvider(api_key='benchmark', base_url=url, max_workers=concurrency)
+
+        rows.append(client.run(run_level(provider, symbols, start_date, end_date, concurrency)))
+        print(' | '.join(f'{key}: {value:,.{0 if isinstance(value, int) else 1}f}' for key, value in rows[-1].items()))
+
+    return rows
+
+
+# %% execute
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='url of an already running stand-in server, otherwise one is started')
+    parser.add_argument('--symbols', type=int, default=200, help='number of symbols per concurrency level')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8, 16, 32, 64])
+    parser.add_argument('--start-date', default='2012-01-01')
+    parser.add_argument('--end-date', default='2023-02-28')
+    parser.add_argument('--requests-per-minute', type=int, default=1_000_000,
+                        help='client side rate limit, set it to the vendor quota to test throttling')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean response time of the started server')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of HTTP 503 of the started server')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of HTTP 429 of the started server')
+    parser.add_argument('--quota', type=int, default=0, help='requests per minute of the started server')
+    args = parser.parse_args()
+
+    server_url = args.url
+
+    if server_url is None:
+        stub_server = start_stub_server(
+            latency=args.latency,
+            error_rate=args.error_rate,
+            throttle_rate=args.throttle_rate,
+            quota=args.quota
+        )
+        server_url = f'http://127.0.0.1:{stub_server.server_port}'
+
+    run_benchmark(server_url, args.symbols, args.concurrency, args.start_date, args.end_date,
+                  args.requests_per_minute)
@@ -0,0 +1,125 @@
+'''
+precision_check.py
+Validation of the float32 return mode of factor_analysis.py against the float64 path.
+Regresses the same fund and factor returns stored as float64 and as float32 with batch_ols,
+and reports the maximum coefficient deviation together with the memory of both return panels.
+The returns are synthetic by default, or retrieved from the local EOD stand-in server with --stub. The stand-in
+returns are retrieved once per return_dtype, so that the float32 returns also carry the rounding of the float32
+price panel, and the memory of every panel kept by the FetchClient is reported: the daily price panel and the
+returns, i.e. 16 bytes per symbol and day in float64 for daily returns against 8 in float32.
+Run with: python precision_check.py --funds 2000 --periods 2800 --factors 14
+'''
+
+import argparse
+import numpy as np
+import pandas as pd
+import factor_analysis as fa
+
+
+# %% functions
+def synthetic_returns(n_funds, n_periods, n_factors, seed=0):
+    """
+    Function to simulate fund returns driven by correlated factor returns, daily sized.
+    :return: tuple(pd.DataFrame, pd.DataFrame). Fund returns and factor returns, float64.
+    """
+
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2012-01-03', periods=n_periods, name='date')
+
+    market = rng.normal(0.0004, 0.01, (n_periods, 1))
+    factors = market + rng.normal(0.0, 0.004, (n_periods, n_factors))
+    betas = rng.dirichlet(np.ones(n_factors), n_funds).T
+    funds = 0.00005 + factors @ betas + rng.normal(0.0, 0.002, (n_periods, n_funds))
+
+    df_funds = pd.DataFrame(funds, index=dates, columns=[f'FUND{i:05d}' for i in range(n_funds)])
+    df_factors = pd.DataFrame(factors, index=dates, columns=[f'FACTOR{i:02d}' for i in range(n_factors)])
+
+    return df_funds, df_factors
+
+
+def stub_returns(n_funds, n_factors, start_date, end_date, frequency, dtype=np.float64):
+    """
+    Function to retrieve fund and factor returns from the local EOD stand-in server with a new FetchClient.
+    :param dtype: np.dtype. return_dtype of the retrieval.
+    :return: tuple(pd.DataFrame, pd.DataFrame, int). Fund returns, factor returns and the bytes of the price and
+        return panels kept by the FetchClient.
+    """
+
+    from eod_stub_server import start_stub_server
+
+    stub_server = start_stub_server(latency=0.0, latency_jitter=0.0)
+    # the stand-in server ignores the API key
+    provider = fa.EODProvider(api_key='precision-check', base_url=f'http://127.0.0.1:{stub_server.server_port}')
+
+    tickers = [f'FUND{i:05d}' for i in range(n_funds)]
+    factors = {f'Factor {i}': f'FACTOR{i:02d}' for i in range(n_factors)}
+
+    fa.price_cache_dir = None
+    fa.return_dtype = dtype
+    fa.fetch_client = fa.FetchClient()
+
+    df_funds, df_factors = fa.run_sync(
+        fa.async_get_all_returns(tickers, factors, start_date, end_date, frequency, provider)
+    )
+    panel_bytes = sum(df.memory_usage(index=False).sum() for df in fa.fetch_client.panels.values())
+    stub_server.shutdown()
+
+    return df_funds, df_factors, panel_bytes
+
+
+def compare_precision(df_funds, df_factors, add_const=True, funds_32=None, factors_32=None):
+    """
+    Function to regress the float64 and the float32 copies of the same returns and compare the coefficients.
+    :param df_funds: pd.DataFrame. float64 fund returns.
+    :param df_factors: pd.DataFrame. float64 factor returns.
+    :param add_const: bool. Add an intercept to the regressions.
+    :param funds_32: pd.DataFrame. float32 fund returns, defaults to a float32 copy of df_funds.
+    :param factors_32: pd.DataFrame. float32 factor returns, defaults to a float32 copy of df_factors.
+    :return: dict. Maximum absolute and relative coefficient deviation, and the memory of both fund panels.
+    """
+
+    funds_32 = (df_funds if funds_32 is None else funds_32).to_numpy(dtype=np.float32)
+    factors_32 = (df_factors if factors_32 is None else factors_32).to_numpy(dtype=np.float32)
+
+    params_64 = fa.batch_ols(df_funds.to_numpy(dtype=np.float64), df_factors, add_const).params
+    params_32 = fa.batch_ols(funds_32, factors_32, add_const).params
+
+    deviation = np.abs(params_32 - params_64)
+    scale = np.abs(params_64).max(axis=0)
+
+    return {
+        'max abs deviation': deviation.max(),
+        'max deviation / largest coefficient': (deviation.max(axis=0) / scale).max(),
+        'max intercept deviation': deviation[0].max() if add_const else np.nan,
+        'float64 MB': df_funds.shape[0] * df_funds.shape[1] * 8 / 1024 ** 2,
+        'float32 MB': funds_32.nbytes / 1024 ** 2,
+    }
+
+
+# %% execute
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--funds', type=int, default=2000)
+    parser.add_argument('--periods', type=int, default=2800, help='number of synthetic periods')
+    parser.add_argument('--factors', type=int, default=14)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stub', action='store_true', help='retrieve the returns from the local EOD stand-in')
+    parser.add_argument('--start-date', default='2012-01-01')
+    parser.add_argument('--end-date', default='2023-02-28')
+    parser.add_argument('--frequency', default='D')
+    args = parser.parse_args()
+
+    if args.stub:
+        stub_args = (args.funds, args.factors, args.start_date, args.end_date, args.frequency)
+        df_funds, df_factors, bytes_64 = stub_returns(*stub_args, dtype=np.float64)
+        funds_32, factors_32, bytes_32 = stub_returns(*stub_args, dtype=np.float32)
+
+        results = compare_precision(df_funds, df_factors, funds_32=funds_32, factors_32=factors_32)
+        results['float64 FetchClient panels MB'] = bytes_64 / 1024 ** 2
+        results['float32 FetchClient panels MB'] = bytes_32 / 1024 ** 2
+    else:
+        df_funds, df_factors = synthetic_returns(args.funds, args.periods, args.factors, args.seed)
+        results = compare_precision(df_funds, df_factors)
+
+    print(f'{df_funds.shape[1]} funds, {df_factors.shape[1]} factors, {df_funds.shape[0]} periods')
+    print('\n'.join(f'{key}: {value:.3g}' for key, value in results.items()))